@@ -1,11 +1,21 @@
 import os
+import re
 import random
 import csv
+import io
 import json
+import sqlite3
+import hashlib
+import zlib
 from datetime import datetime, UTC, timedelta, time as dt_time
 import time as time_module
+import threading
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import Future, ThreadPoolExecutor
 from collections import defaultdict
-from telegram.error import TimedOut
+from telegram.error import TimedOut, NetworkError, RetryAfter, BadRequest, Forbidden
 
 from telegram import (
     Update,
@@ -18,6 +28,7 @@ from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     ContextTypes,
     MessageHandler,
     filters,
@@ -28,15 +39,79 @@ from telegram.constants import ParseMode
 import gspread
 from gspread.auth import service_account_from_dict
 
+# Pillow нужен только для уменьшенных копий картинок; без него шлём оригиналы
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 PORT = int(os.getenv("PORT", "10000"))
 
 import time
 
-USERS_CACHE = {'data': None, 'timestamp': 0}
-ACTIONS_CACHE = {'data': None, 'timestamp': 0}
 CACHE_TTL = 300
 
+# Локальная база событий; лист Google Sheets — её зеркало.
+# На Render DB_PATH должен указывать на persistent disk (например /var/data/tarot_bot.sqlite3):
+# файловая система сервиса стирается при каждом деплое и рестарте.
+DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tarot_bot.sqlite3"))
+
+# Репликация в Sheets: раз в N секунд или при накоплении M новых строк
+LOG_FLUSH_INTERVAL = int(os.getenv("LOG_FLUSH_INTERVAL", "10"))
+LOG_FLUSH_MAX_ROWS = int(os.getenv("LOG_FLUSH_MAX_ROWS", "50"))
+
+# Сколько месяцев actions_YYYY_MM (включая текущий) хранить строками; старее — только в daily_stats
+ACTIONS_KEEP_MONTHS = int(os.getenv("ACTIONS_KEEP_MONTHS", "3"))
+
+# Рассылки: лимит Telegram ~30 сообщений/с на бота и 1 сообщение/с в один чат
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "100"))  # отправок между записями прогресса
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # не чаще, чем раз в N секунд
+# Окна массовых джоб: получатели равномерно распределяются на N секунд (0 — сразу всем)
+DAILY_REMINDER_WINDOW = int(os.getenv("DAILY_REMINDER_WINDOW", "1800"))
+AUTO_NURTURE_WINDOW = int(os.getenv("AUTO_NURTURE_WINDOW", "1800"))
+
+# Статус подписки на канал: опрошенный get_chat_member статус живёт MEMBERSHIP_TTL секунд,
+# фоновая перепроверка — пачками по MEMBERSHIP_REFRESH_BATCH, не больше RATE запросов/с
+MEMBERSHIP_TTL = int(os.getenv("MEMBERSHIP_TTL", "21600"))
+MEMBERSHIP_REFRESH_INTERVAL = int(os.getenv("MEMBERSHIP_REFRESH_INTERVAL", "900"))
+MEMBERSHIP_REFRESH_CONCURRENCY = int(os.getenv("MEMBERSHIP_REFRESH_CONCURRENCY", "10"))
+MEMBERSHIP_REFRESH_RATE = float(os.getenv("MEMBERSHIP_REFRESH_RATE", "20"))
+MEMBERSHIP_REFRESH_BATCH = int(os.getenv("MEMBERSHIP_REFRESH_BATCH", "200"))
+
+# Прогрев file_id: все картинки один раз загружаются в этот чат (например, служебную группу),
+# чтобы пользователям они уходили уже по file_id. Без чата прогрев при старте не запускается.
+MEDIA_WARMUP_CHAT_ID = int(os.getenv("MEDIA_WARMUP_CHAT_ID", "0")) or None
+MEDIA_WARMUP_ON_START = os.getenv("MEDIA_WARMUP_ON_START", "1") == "1"
+MEDIA_WARMUP_CONCURRENCY = int(os.getenv("MEDIA_WARMUP_CONCURRENCY", "4"))
+# Интервал (сек) между загрузками прогрева: в группу Telegram пускает ~20 сообщений в минуту
+MEDIA_WARMUP_INTERVAL = float(os.getenv("MEDIA_WARMUP_INTERVAL", "3"))
+# Как часто (сек) сверять mtime папок с картинками, чтобы подхватить добавленные / удалённые файлы
+ASSET_RECHECK_INTERVAL = float(os.getenv("ASSET_RECHECK_INTERVAL", "30"))
+# Уменьшенные копии картинок: Telegram всё равно ужимает фото до 1280 px по большей стороне
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1280"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+
+# Пулы потоков для блокирующих вызовов gspread: интерактивные и фоновые раздельно
+GS_MAX_WORKERS = int(os.getenv("GS_MAX_WORKERS", "4"))
+GS_BACKGROUND_WORKERS = int(os.getenv("GS_BACKGROUND_WORKERS", "2"))
+# Пул потоков для запросов к локальной базе
+STORE_MAX_WORKERS = int(os.getenv("STORE_MAX_WORKERS", "4"))
+
+# Квоты Sheets API (запросов в минуту) и повторы при 429/5xx
+GS_READ_QUOTA_PER_MIN = int(os.getenv("GS_READ_QUOTA_PER_MIN", "60"))
+GS_WRITE_QUOTA_PER_MIN = int(os.getenv("GS_WRITE_QUOTA_PER_MIN", "60"))
+GS_BACKGROUND_RESERVE = float(os.getenv("GS_BACKGROUND_RESERVE", "0.25"))  # доля квоты только для интерактивных
+GS_MAX_RETRIES = int(os.getenv("GS_MAX_RETRIES", "5"))
+GS_BACKOFF_BASE = float(os.getenv("GS_BACKOFF_BASE", "1.0"))
+GS_BACKOFF_MAX = float(os.getenv("GS_BACKOFF_MAX", "32.0"))
+
+# Индекс user_id -> строки листа users перестраиваем не реже раза в час
+USERS_INDEX_TTL = int(os.getenv("USERS_INDEX_TTL", "3600"))
+
 # ===== Render Environment ===== Админы
 ADMIN_IDS = {
     int(id.strip()) for id in os.getenv("ADMIN_IDS", "").split(",")
@@ -57,6 +132,7 @@ META_CARDS_DIR = os.path.join(BASE_DIR, "meta_cards")
 DICE_DIR = os.path.join(BASE_DIR, "dice")
 PACKS_DIR = os.path.join(BASE_DIR, "packs_images")
 CARD_OF_DAY_DIR = os.path.join(BASE_DIR, "card_of_day_images")
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", os.path.join(BASE_DIR, ".image_cache"))
 
 # Статус карты дня: True = авто, False = ручная
 CARD_OF_DAY_ENABLED = True
@@ -70,6 +146,8 @@ ACTIONS_SHEET_NAME = "actions"
 NURTURE_SHEET_NAME = "nurture"
 CARD_OF_DAY_SHEET_NAME = "card_of_day"
 AUTO_NURTURE_SHEET_NAME = "auto_nurture" # <-- НОВАЯ СТРОКА
+DAILY_STATS_SHEET_NAME = "daily_stats"
+AUTO_NURTURE_TEXTS_SHEET_NAME = "auto_nurture_texts"  # версия текста авторассылки -> сам текст
 
 GS_CLIENT = None
 GS_SHEET = None
@@ -79,6 +157,8 @@ GS_NURTURE_WS = None
 GS_CARD_OF_DAY_WS = None
 GS_PACKS_WS = None
 GS_AUTO_NURTURE_WS = None # <-- НОВАЯ СТРОКА
+GS_DAILY_STATS_WS = None
+GS_AUTO_NURTURE_TEXTS_WS = None
 PACKS_DATA = {}  # словарь: {code: {title, emoji, description, filename}}
 
 def get_admin_keyboard():
@@ -95,6 +175,7 @@ def get_admin_keyboard():
 
 def init_gs_client():
     global GS_CLIENT, GS_SHEET, GS_USERS_WS, GS_ACTIONS_WS, GS_NURTURE_WS, GS_CARD_OF_DAY_WS, GS_PACKS_WS, GS_AUTO_NURTURE_WS # <-- Добавлено GS_AUTO_NURTURE_WS
+    global GS_DAILY_STATS_WS, GS_AUTO_NURTURE_TEXTS_WS
     if not GS_SERVICE_JSON or not GS_SHEET_ID:
         print(">>> Google Sheets: переменные GS_SERVICE_JSON / GS_SHEET_ID не заданы.")
         return
@@ -132,16 +213,47 @@ def init_gs_client():
             auto_nurture_ws = None
         # --- КОНЕЦ НОВОГО КОДА ---
 
+        # дневные агрегаты: вкладку создаём сами, если её нет
+        try:
+            daily_stats_ws = sheet.worksheet(DAILY_STATS_SHEET_NAME)
+        except gspread.exceptions.WorksheetNotFound:
+            try:
+                daily_stats_ws = sheet.add_worksheet(
+                    title=DAILY_STATS_SHEET_NAME, rows=1000, cols=len(DAILY_STATS_COLUMNS)
+                )
+                print(f">>> init_gs_client: вкладка '{DAILY_STATS_SHEET_NAME}' создана.")
+            except Exception as e:
+                print(f">>> init_gs_client: не удалось создать вкладку '{DAILY_STATS_SHEET_NAME}': {e}")
+                daily_stats_ws = None
+
+        # тексты авторассылки по версиям: тоже создаём сами, с заголовком
+        try:
+            auto_nurture_texts_ws = sheet.worksheet(AUTO_NURTURE_TEXTS_SHEET_NAME)
+        except gspread.exceptions.WorksheetNotFound:
+            try:
+                auto_nurture_texts_ws = sheet.add_worksheet(
+                    title=AUTO_NURTURE_TEXTS_SHEET_NAME, rows=100,
+                    cols=len(STORE_TABLES[AUTO_NURTURE_TEXTS_SHEET_NAME]),
+                )
+                auto_nurture_texts_ws.append_row(STORE_TABLES[AUTO_NURTURE_TEXTS_SHEET_NAME], value_input_option="RAW")
+                print(f">>> init_gs_client: вкладка '{AUTO_NURTURE_TEXTS_SHEET_NAME}' создана.")
+            except Exception as e:
+                print(f">>> init_gs_client: не удалось создать вкладку '{AUTO_NURTURE_TEXTS_SHEET_NAME}': {e}")
+                auto_nurture_texts_ws = None
+
         # --- ОСНОВНОЕ ПРИСВАИВАНИЕ ПЕРЕМЕННЫХ ---
         # Эти строки выполняются ТОЛЬКО если основной try (до этого места) завершился успешно
+        # все вкладки — через обёртку с квотами и повторами (см. SheetsQuota)
         GS_CLIENT = client
         GS_SHEET = sheet
-        GS_USERS_WS = users_ws
-        GS_ACTIONS_WS = actions_ws
-        GS_NURTURE_WS = nurture_ws
-        GS_CARD_OF_DAY_WS = card_of_day_ws
-        GS_PACKS_WS = packs_ws
-        GS_AUTO_NURTURE_WS = auto_nurture_ws # <-- Присваиваем, даже если None
+        GS_USERS_WS = with_quota(users_ws)
+        GS_ACTIONS_WS = with_quota(actions_ws)
+        GS_NURTURE_WS = with_quota(nurture_ws)
+        GS_CARD_OF_DAY_WS = with_quota(card_of_day_ws)
+        GS_PACKS_WS = with_quota(packs_ws)
+        GS_AUTO_NURTURE_WS = with_quota(auto_nurture_ws) # <-- Присваиваем, даже если None
+        GS_DAILY_STATS_WS = with_quota(daily_stats_ws)
+        GS_AUTO_NURTURE_TEXTS_WS = with_quota(auto_nurture_texts_ws)
         print(">>> Google Sheets: успешно подключено к tatiataro_log.")
         # --- КОНЕЦ ПРИСВАИВАНИЯ ---
 
@@ -156,6 +268,8 @@ def init_gs_client():
         GS_CARD_OF_DAY_WS = None
         GS_PACKS_WS = None
         GS_AUTO_NURTURE_WS = None # <-- Важно: сбросить и новую переменную тоже
+        GS_DAILY_STATS_WS = None
+        GS_AUTO_NURTURE_TEXTS_WS = None
     
 def load_json(name):
     path = os.path.join(TEXTS_DIR, name)
@@ -210,6 +324,16 @@ def parse_iso(dt_str: str) -> datetime | None:
         return None
 
 
+def iso_to_epoch(dt_str: str) -> float | None:
+    """ISO-строка → секунды от эпохи (время без зоны считаем UTC)."""
+    dt = parse_iso(dt_str)
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=UTC)
+    return dt.timestamp()
+
+
 def load_last_report_ts() -> datetime:
     if not os.path.exists(LAST_REPORT_FILE):
         return datetime.now(UTC) - timedelta(hours=1)
@@ -225,13 +349,857 @@ def save_last_report_ts(ts: datetime):
     with open(LAST_REPORT_FILE, "w", encoding="utf-8") as f:
         f.write(ts.isoformat(timespec="seconds"))
 
-# ===== логирование в Google Sheets =====
+# ===== асинхронный доступ к Google Sheets =====
 
+GS_EXECUTOR = ThreadPoolExecutor(max_workers=GS_MAX_WORKERS, thread_name_prefix="gsheets")
+# Фоновые задачи ждут квоту и спят в backoff в своих потоках — интерактивный пул им не занять
+GS_BACKGROUND_EXECUTOR = ThreadPoolExecutor(max_workers=GS_BACKGROUND_WORKERS, thread_name_prefix="gsheets-bg")
 
-def log_start_to_sheet(user, card_key: str | None):
-    """Лог входа пользователя в лист users."""
-    if GS_USERS_WS is None:
+
+async def run_gs(func, *args, **kwargs):
+    """Выполняем блокирующий вызов gspread в пуле потоков, не останавливая event loop.
+
+    Пул выбирается по GS_PRIORITY текущей задачи.
+    """
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, func, *args, **kwargs)
+    executor = GS_BACKGROUND_EXECUTOR if GS_PRIORITY.get() == GS_BACKGROUND else GS_EXECUTOR
+    return await loop.run_in_executor(executor, call)
+
+
+# Локальная база (SQLite) — свой пул: её вызовы не ждут квоты и backoff Google Sheets
+STORE_EXECUTOR = ThreadPoolExecutor(max_workers=STORE_MAX_WORKERS, thread_name_prefix="store")
+
+
+async def run_store(func, *args, **kwargs):
+    """Выполняем блокирующий вызов локальной базы в её пуле потоков."""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, func, *args, **kwargs)
+    return await loop.run_in_executor(STORE_EXECUTOR, call)
+
+
+def store_later(func, *args, **kwargs):
+    """Запись в локальную базу «в фоне»: хендлер не ждёт её и не держит event loop."""
+    ctx = contextvars.copy_context()
+    future = STORE_EXECUTOR.submit(ctx.run, func, *args, **kwargs)
+
+    def _report(f):
+        if f.exception() is not None:
+            print(f">>> store_later({getattr(func, '__name__', func)}) error: {f.exception()}")
+
+    future.add_done_callback(_report)
+    return future
+
+# ===== квоты Google Sheets =====
+
+GS_INTERACTIVE = "interactive"
+GS_BACKGROUND = "background"
+# Приоритет текущей задачи: джобы и репликатор ставят GS_BACKGROUND
+GS_PRIORITY = contextvars.ContextVar("gs_priority", default=GS_INTERACTIVE)
+
+GS_READ_METHODS = {
+    "get_all_values", "get_all_records", "get_values", "get", "batch_get",
+    "row_values", "col_values", "acell", "cell", "find", "findall",
+}
+GS_WRITE_METHODS = {
+    "append_row", "append_rows", "update", "update_cell", "update_acell",
+    "update_cells", "batch_update", "clear", "batch_clear",
+    "insert_row", "insert_rows", "delete_rows", "resize",
+}
+
+
+class TokenBucket:
+    """Токен-бакет на минутную квоту: capacity запросов, пополнение capacity/60 в секунду.
+
+    Фоновые задачи не опускают бакет ниже reserve токенов, поэтому
+    интерактивные запросы получают квоту первыми.
+    """
+
+    def __init__(self, name: str, per_minute: int, reserve_share: float):
+        self.name = name
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.reserve = self.capacity * reserve_share
+        self._tokens = self.capacity
+        self._updated = time_module.monotonic()
+        self._lock = threading.Lock()
+        self.waits = 0
+
+    def acquire(self, background: bool = False):
+        """Блокирует поток, пока не появится токен."""
+        floor = self.reserve if background else 0.0
+        waited = False
+        while True:
+            with self._lock:
+                now = time_module.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens - 1 >= floor:
+                    self._tokens -= 1
+                    if waited:
+                        self.waits += 1
+                    return
+                delay = (floor + 1 - self._tokens) / self.rate
+            waited = True
+            time_module.sleep(min(delay, 5.0))
+
+
+def _is_transient_gs_error(e: Exception) -> bool:
+    """429 / 5xx от Sheets API и сетевые ошибки стоит повторить."""
+    if isinstance(e, gspread.exceptions.APIError):
+        code = getattr(getattr(e, "response", None), "status_code", None)
+        return code in (429, 500, 502, 503, 504)
+    # сетевые ошибки requests наследуются от OSError
+    return isinstance(e, (OSError, TimeoutError))
+
+
+class SheetsQuota:
+    """Пропускает вызовы gspread через бакеты чтения/записи и повторяет временные ошибки."""
+
+    def __init__(self):
+        self.read = TokenBucket("read", GS_READ_QUOTA_PER_MIN, GS_BACKGROUND_RESERVE)
+        self.write = TokenBucket("write", GS_WRITE_QUOTA_PER_MIN, GS_BACKGROUND_RESERVE)
+        self.retries = 0
+
+    def call(self, kind: str, func, *args, **kwargs):
+        bucket = self.read if kind == "read" else self.write
+        background = GS_PRIORITY.get() == GS_BACKGROUND
+        for attempt in range(GS_MAX_RETRIES + 1):
+            bucket.acquire(background)
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= GS_MAX_RETRIES or not _is_transient_gs_error(e):
+                    raise
+                # экспоненциальная задержка с джиттером: половина фиксированная, половина случайная
+                delay = min(GS_BACKOFF_MAX, GS_BACKOFF_BASE * 2 ** attempt)
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                self.retries += 1
+                print(f">>> Sheets {kind} {getattr(func, '__name__', func)}: {e} — "
+                      f"повтор через {delay:.1f} с ({attempt + 1}/{GS_MAX_RETRIES})")
+                time_module.sleep(delay)
+
+
+SHEETS_QUOTA = SheetsQuota()
+
+
+class QuotaWorksheet:
+    """Обёртка над gspread.Worksheet: чтения и записи идут через SHEETS_QUOTA."""
+
+    def __init__(self, ws):
+        self._ws = ws
+
+    def __getattr__(self, name):
+        attr = getattr(self._ws, name)
+        if name in GS_READ_METHODS:
+            return functools.partial(SHEETS_QUOTA.call, "read", attr)
+        if name in GS_WRITE_METHODS:
+            return functools.partial(SHEETS_QUOTA.call, "write", attr)
+        return attr
+
+    def __repr__(self):
+        return f"QuotaWorksheet({self._ws!r})"
+
+
+def with_quota(ws):
+    return QuotaWorksheet(ws) if ws is not None else None
+
+# ===== локальное хранилище событий (SQLite) =====
+
+# Колонки таблиц — в том же порядке, что и столбцы одноимённых вкладок
+STORE_TABLES = {
+    USERS_SHEET_NAME: ["user_id", "username", "first_name", "card_key", "date_iso", "subscribed"],
+    ACTIONS_SHEET_NAME: ["user_id", "username", "first_name", "action", "source", "ts_iso"],
+    NURTURE_SHEET_NAME: ["user_id", "card_key", "segment", "day_num", "sent_at", "status", "error_msg", "subscribed_after"],
+    AUTO_NURTURE_SHEET_NAME: ["user_id", "username", "first_name", "action", "sent_date", "status", "error_msg", "text", "period"],
+    AUTO_NURTURE_TEXTS_SHEET_NAME: ["version", "text", "created_at"],
+}
+# Колонка времени события в каждой таблице (по ней выборки за период)
+STORE_TIME_COLUMNS = {
+    USERS_SHEET_NAME: "date_iso",
+    ACTIONS_SHEET_NAME: "ts_iso",
+    NURTURE_SHEET_NAME: "sent_at",
+    AUTO_NURTURE_SHEET_NAME: "sent_date",
+    AUTO_NURTURE_TEXTS_SHEET_NAME: "created_at",
+}
+
+# Дневные агрегаты: (day, kind, action, source, card_key, segment) -> count.
+# kind — таблица события; для users action = "start", для nurture action = "day_N", source = статус.
+DAILY_STATS_KEY = ["day", "kind", "action", "source", "card_key", "segment"]
+DAILY_STATS_COLUMNS = DAILY_STATS_KEY + ["count"]
+
+
+def rollup_key(table: str, record: dict) -> tuple | None:
+    """Ключ дневного агрегата для строки события (день — дата UTC из колонки времени)."""
+    day = (record.get(STORE_TIME_COLUMNS[table]) or "")[:10]
+    if not day:
+        return None
+    if table == USERS_SHEET_NAME:
+        return (day, table, "start", "", record.get("card_key", ""), "")
+    if table == ACTIONS_SHEET_NAME:
+        return (day, table, record.get("action", ""), record.get("source", ""), "", "")
+    if table == NURTURE_SHEET_NAME:
+        return (day, table, f"day_{record.get('day_num', '')}", record.get("status", ""),
+                record.get("card_key", ""), record.get("segment", ""))
+    if table == AUTO_NURTURE_SHEET_NAME:
+        return (day, table, record.get("action", ""), record.get("status", ""), "", "")
+    return None
+
+
+class EventStore:
+    """Основное хранилище событий бота: users / actions / nurture / auto_nurture.
+
+    Хендлеры пишут сюда, отчёты и джобы читают отсюда по индексам
+    (user_id и время события). Вкладки Google Sheets догоняет SheetsReplicator.
+
+    Записи идут через одно соединение под self._lock и короткие. Чтения —
+    через отдельное соединение в каждом потоке (WAL позволяет читать
+    параллельно с записью), поэтому долгие выборки из пула потоков
+    не задерживают запись из хендлеров в event loop.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._local = threading.local()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            for table, columns in STORE_TABLES.items():
+                cols_sql = ", ".join(f"{c} TEXT NOT NULL DEFAULT ''" for c in columns)
+                time_col = STORE_TIME_COLUMNS[table]
+                self._conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, {cols_sql})"
+                )
+                if "user_id" in columns:
+                    self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_id ON {table}(user_id)")
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{time_col} ON {table}({time_col})")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS replication_state ("
+                "table_name TEXT PRIMARY KEY, last_id INTEGER NOT NULL)"
+            )
+            # sheet_row — строка во вкладке daily_stats, dirty — счётчик ещё не отправлен
+            key_sql = ", ".join(f"{c} TEXT NOT NULL" for c in DAILY_STATS_KEY)
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS daily_stats ({key_sql}, "
+                "count INTEGER NOT NULL DEFAULT 0, sheet_row INTEGER, dirty INTEGER NOT NULL DEFAULT 1, "
+                f"PRIMARY KEY ({', '.join(DAILY_STATS_KEY)}))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_daily_stats_dirty ON daily_stats(dirty)")
+            # авторассылка: user_id -> дата последней отправки (YYYY-MM-DD), ведётся при записи истории
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS auto_nurture_last_sent ("
+                "user_id TEXT PRIMARY KEY, sent_date TEXT NOT NULL)"
+            )
+            if not self._conn.execute("SELECT 1 FROM auto_nurture_last_sent LIMIT 1").fetchone():
+                self._conn.execute(
+                    "INSERT INTO auto_nurture_last_sent (user_id, sent_date) "
+                    f"SELECT user_id, MAX(sent_date) FROM {AUTO_NURTURE_SHEET_NAME} "
+                    "WHERE user_id != '' AND sent_date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]' "
+                    "GROUP BY user_id"
+                )
+            self._conn.commit()
+        if self.count("daily_stats") == 0:
+            self.rebuild_daily_stats()
+
+    def insert_many(self, table: str, rows: list[list]) -> list[dict]:
+        """Добавляем строки (значения в порядке STORE_TABLES), возвращаем их как записи с id."""
+        if not rows:
+            return []
+        columns = STORE_TABLES[table]
+        placeholders = ", ".join("?" for _ in columns)
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+        records = []
+        with self._lock:
+            for row in rows:
+                values = [str(v) for v in row]
+                cur = self._conn.execute(sql, values)
+                record = dict(zip(columns, values))
+                record["id"] = cur.lastrowid
+                records.append(record)
+            # агрегаты и индекс авторассылки обновляем в той же транзакции, что и сами события
+            self._bump_daily_stats(table, records)
+            if table == AUTO_NURTURE_SHEET_NAME:
+                self._bump_last_sent(records)
+            self._conn.commit()
+        return records
+
+    def _bump_last_sent(self, records: list[dict]):
+        self._conn.executemany(
+            "INSERT INTO auto_nurture_last_sent (user_id, sent_date) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET sent_date = MAX(sent_date, excluded.sent_date)",
+            [
+                (r["user_id"], r["sent_date"]) for r in records
+                if r["user_id"] and re.fullmatch(r"\d{4}-\d{2}-\d{2}", r["sent_date"])
+            ],
+        )
+
+    def auto_nurture_last_sent(self) -> dict[str, str]:
+        """user_id -> дата последней авторассылки ('YYYY-MM-DD')."""
+        return dict(self._reader().execute("SELECT user_id, sent_date FROM auto_nurture_last_sent").fetchall())
+
+    def _bump_daily_stats(self, table: str, records: list[dict]):
+        counts = defaultdict(int)
+        for record in records:
+            key = rollup_key(table, record)
+            if key is not None:
+                counts[key] += 1
+        if not counts:
+            return
+        self._conn.executemany(
+            f"INSERT INTO daily_stats ({', '.join(DAILY_STATS_KEY)}, count, dirty) "
+            f"VALUES ({', '.join('?' for _ in DAILY_STATS_KEY)}, ?, 1) "
+            f"ON CONFLICT({', '.join(DAILY_STATS_KEY)}) "
+            "DO UPDATE SET count = count + excluded.count, dirty = 1",
+            [(*key, n) for key, n in counts.items()],
+        )
+
+    def rebuild_daily_stats(self):
+        """Пересчитываем агрегаты по всем событиям (база, созданная до появления daily_stats)."""
+        with self._lock:
+            self._conn.execute("DELETE FROM daily_stats")
+            for table, columns in STORE_TABLES.items():
+                cur = self._conn.execute(f"SELECT {', '.join(columns)} FROM {table}")
+                while True:
+                    chunk = cur.fetchmany(1000)
+                    if not chunk:
+                        break
+                    self._bump_daily_stats(table, [dict(r) for r in chunk])
+            self._conn.commit()
+            total = self._conn.execute("SELECT COUNT(*) FROM daily_stats").fetchone()[0]
+        if total:
+            print(f">>> EventStore: дневные агрегаты пересчитаны ({total} ключей)")
+
+    def daily_counts(self, kind: str, since_day: str, until_day: str = "9999-12-31") -> list[dict]:
+        """Суммы агрегатов kind за дни since_day..until_day (включительно) по остальным полям ключа."""
+        return self.query(
+            "SELECT action, source, card_key, segment, SUM(count) AS count FROM daily_stats "
+            "WHERE kind = ? AND day >= ? AND day <= ? "
+            "GROUP BY action, source, card_key, segment",
+            (kind, since_day, until_day),
+        )
+
+    def fetch(self, table: str, after_id: int = 0, since: str | None = None,
+              limit: int | None = None) -> list[dict]:
+        """Строки таблицы с id > after_id (и временем события >= since) по порядку записи."""
+        sql = f"SELECT * FROM {table} WHERE id > ?"
+        params: list = [after_id]
+        if since:
+            sql += f" AND {STORE_TIME_COLUMNS[table]} >= ?"
+            params.append(since)
+        sql += " ORDER BY id"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self.query(sql, params)
+
+    def _reader(self) -> sqlite3.Connection:
+        """Соединение только для чтения, своё у каждого потока."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA query_only=ON")
+            self._local.conn = conn
+        return conn
+
+    def query(self, sql: str, params=()) -> list[dict]:
+        return [dict(r) for r in self._reader().execute(sql, params).fetchall()]
+
+    def execute(self, sql: str, params=()) -> int:
+        with self._lock:
+            cur = self._conn.execute(sql, params)
+            self._conn.commit()
+            return cur.rowcount
+
+    def execute_many(self, sql: str, seq_of_params) -> int:
+        with self._lock:
+            cur = self._conn.executemany(sql, seq_of_params)
+            self._conn.commit()
+            return cur.rowcount
+
+    def count(self, table: str) -> int:
+        return self._reader().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def max_id(self, table: str) -> int:
+        return self._reader().execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+
+    def get_cursor(self, table: str) -> int:
+        row = self._reader().execute(
+            "SELECT last_id FROM replication_state WHERE table_name = ?", (table,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def set_cursor(self, table: str, last_id: int):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO replication_state (table_name, last_id) VALUES (?, ?) "
+                "ON CONFLICT(table_name) DO UPDATE SET last_id = excluded.last_id",
+                (table, last_id),
+            )
+            self._conn.commit()
+
+    def set_subscribed(self, flags: dict):
+        self.execute_many(
+            "UPDATE users SET subscribed = ? WHERE user_id = ?",
+            [("sub" if is_sub else "unsub", str(uid)) for uid, is_sub in flags.items()],
+        )
+
+    def user_status_map(self) -> dict[str, str]:
+        """user_id -> subscribed из последней строки пользователя."""
+        rows = self.query(
+            "SELECT user_id, subscribed FROM users WHERE id IN "
+            "(SELECT MAX(id) FROM users GROUP BY user_id)"
+        )
+        return {r["user_id"]: r["subscribed"] for r in rows}
+
+
+STORE = EventStore(DB_PATH)
+
+# ===== репликация в Google Sheets =====
+
+
+class SheetsReplicator:
+    """Зеркалит новые строки из SQLite во вкладки Google Sheets.
+
+    Для каждой таблицы помним id последней переданной строки (replication_state).
+    Фоновый поток раз в interval секунд, или раньше, если набралось max_rows
+    новых строк, дописывает хвост одним append_rows на вкладку. Если Sheets
+    недоступен, строки остаются в базе и уйдут при следующей попытке.
+    """
+
+    def __init__(self, store: EventStore, interval: float, max_rows: int, batch_size: int = 500):
+        self.store = store
+        self.interval = interval
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        self._worksheets: dict[str, object] = {}  # таблица -> worksheet
+        self._resolvers: dict[str, object] = {}  # таблица -> resolver(record) -> worksheet
+        self._listeners: dict[str, list] = {}  # таблица -> колбэки (start_row, rows)
+        self._pending: dict[str, int] = {}  # таблица -> новых строк с последней записи
+        self._hooks: list = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def attach(self, table: str, ws):
+        if ws is not None:
+            self._worksheets[table] = ws
+
+    def attach_partitioned(self, table: str, resolver):
+        """Строки таблицы раскладываются по нескольким вкладкам: resolver(record) -> worksheet."""
+        self._resolvers[table] = resolver
+
+    def _tables(self) -> list[str]:
+        return list(dict.fromkeys([*self._worksheets, *self._resolvers]))
+
+    def add_listener(self, table: str, callback):
+        """callback(start_row, rows) вызывается после успешной записи пачки во вкладку."""
+        self._listeners.setdefault(table, []).append(callback)
+
+    def notify(self, table: str, count: int = 1):
+        """В таблицу добавлены строки — будим поток, если их накопилось много."""
+        with self._lock:
+            self._pending[table] = self._pending.get(table, 0) + count
+            is_full = self._pending[table] >= self.max_rows
+        if is_full:
+            self._wakeup.set()
+
+    def backlog(self) -> int:
+        """Сколько строк ещё не отправлено в Sheets."""
+        total = 0
+        for table in self._tables():
+            total += self.store.max_id(table) - self.store.get_cursor(table)
+        return total
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="sheets-replicator", daemon=True)
+        self._thread.start()
+        print(f">>> SheetsReplicator: запущен (каждые {self.interval} с или по {self.max_rows} строк)")
+
+    def add_flush_hook(self, callback):
+        """callback() вызывается в конце каждого flush (в потоке репликатора)."""
+        self._hooks.append(callback)
+
+    def _run(self):
+        GS_PRIORITY.set(GS_BACKGROUND)
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Отправляем в Sheets всё, что ещё не отправлено."""
+        with self._flush_lock:
+            for table in self._tables():
+                self._flush_table(table)
+            for hook in self._hooks:
+                try:
+                    hook()
+                except Exception as e:
+                    print(f">>> SheetsReplicator: ошибка {getattr(hook, '__qualname__', hook)}: {e}")
+
+    def _flush_table(self, table: str):
+        columns = STORE_TABLES[table]
+        resolve = self._resolvers.get(table)
+        last_id = self.store.get_cursor(table)
+        while True:
+            records = self.store.fetch(table, after_id=last_id, limit=self.batch_size)
+            if not records:
+                break
+            # подряд идущие строки одной вкладки — одним append_rows
+            for records_group in self._group_by_worksheet(records, resolve, table):
+                ws, group = records_group
+                rows = [[r[c] for c in columns] for r in group]
+                try:
+                    if ws is None:
+                        raise RuntimeError("вкладка недоступна")
+                    response = ws.append_rows(rows, value_input_option="RAW")
+                except Exception as e:
+                    print(f">>> SheetsReplicator: ошибка записи {len(rows)} строк в '{table}': {e}")
+                    return
+                last_id = group[-1]["id"]
+                self.store.set_cursor(table, last_id)
+                self._notify_listeners(table, response, rows)
+        with self._lock:
+            self._pending[table] = 0
+
+    def _group_by_worksheet(self, records: list[dict], resolve, table: str):
+        if resolve is None:
+            yield self._worksheets[table], records
+            return
+        group, group_ws = [], None
+        for record in records:
+            try:
+                ws = resolve(record)
+            except Exception as e:
+                print(f">>> SheetsReplicator: не удалось выбрать вкладку для '{table}': {e}")
+                ws = None
+            if group and ws is not group_ws:
+                yield group_ws, group
+                group = []
+            group_ws = ws
+            group.append(record)
+        if group:
+            yield group_ws, group
+
+    def _notify_listeners(self, table: str, response, rows: list[list]):
+        listeners = self._listeners.get(table)
+        if not listeners:
+            return
+        start_row = _appended_start_row(response)
+        if start_row is None:
+            return
+        for callback in listeners:
+            try:
+                callback(start_row, rows)
+            except Exception as e:
+                print(f">>> SheetsReplicator: ошибка колбэка для '{table}': {e}")
+
+    def stop(self):
+        """Останавливаем поток и дописываем в Sheets всё, что осталось."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+            self._thread = None
+        self.flush()
+        left = self.backlog()
+        if left:
+            print(f">>> SheetsReplicator: при остановке не отправлено {left} строк (уйдут после рестарта)")
+
+
+def _appended_start_row(response) -> int | None:
+    """Номер первой дописанной строки из ответа append_rows ('users!A12:F14' -> 12)."""
+    try:
+        updated_range = response["updates"]["updatedRange"]
+    except (TypeError, KeyError):
+        return None
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    return int(match.group(1)) if match else None
+
+
+REPLICATOR = SheetsReplicator(STORE, LOG_FLUSH_INTERVAL, LOG_FLUSH_MAX_ROWS)
+
+
+class DailyStatsSheetSync:
+    """Зеркалит daily_stats во вкладку: новые ключи дописывает в конец,
+    изменившиеся счётчики переписывает на месте одним batch_update.
+    """
+
+    def __init__(self, store: EventStore):
+        self.store = store
+        self.ws = None
+
+    def bind(self, ws):
+        """Подключаем вкладку и сопоставляем уже записанные в неё строки с ключами в базе."""
+        if ws is None:
+            return
+        values = ws.get_all_values()
+        if not values:
+            ws.append_row(DAILY_STATS_COLUMNS, value_input_option="RAW")
+            values = [DAILY_STATS_COLUMNS]
+        width = len(DAILY_STATS_KEY)
+        known = []
+        for row_num, row in enumerate(values[1:], start=2):
+            row = (row + [""] * (width + 1))[:width + 1]
+            if not row[0]:
+                continue
+            try:
+                count = int(row[width] or 0)
+            except ValueError:
+                count = 0
+            known.append((*row[:width], count, row_num))
+        # ключи, которых нет в базе (сжатые месяцы или новый диск), берём из вкладки как есть;
+        # для остальных запоминаем строку, а переписывать будем только расходящиеся счётчики
+        self.store.execute_many(
+            f"INSERT INTO daily_stats ({', '.join(DAILY_STATS_KEY)}, count, sheet_row, dirty) "
+            f"VALUES ({', '.join('?' for _ in DAILY_STATS_KEY)}, ?, ?, 0) "
+            f"ON CONFLICT({', '.join(DAILY_STATS_KEY)}) "
+            "DO UPDATE SET sheet_row = excluded.sheet_row, "
+            "dirty = CASE WHEN daily_stats.count = excluded.count THEN 0 ELSE 1 END",
+            known,
+        )
+        self.ws = ws
+        print(f">>> DailyStatsSheetSync: вкладка '{DAILY_STATS_SHEET_NAME}', строк {len(known)}")
+
+    def flush(self):
+        if self.ws is None:
+            return
+        rows = self.store.query("SELECT * FROM daily_stats WHERE dirty = 1 ORDER BY day")
+        if not rows:
+            return
+        changed = [r for r in rows if r["sheet_row"] is not None]
+        new = [r for r in rows if r["sheet_row"] is None]
+        count_col = len(DAILY_STATS_COLUMNS)
+
+        if changed:
+            self.ws.batch_update(
+                [
+                    {"range": gspread.utils.rowcol_to_a1(r["sheet_row"], count_col), "values": [[r["count"]]]}
+                    for r in changed
+                ],
+                value_input_option="RAW",
+            )
+            self._mark_synced(changed)
+
+        if new:
+            response = self.ws.append_rows(
+                [[r[c] for c in DAILY_STATS_COLUMNS] for r in new], value_input_option="RAW"
+            )
+            start_row = _appended_start_row(response)
+            if start_row is None:
+                # в ответе нет updatedRange — номера строк узнаём, перечитав вкладку;
+                # без них ключи остались бы без sheet_row и дописались бы ещё раз
+                self.bind(self.ws)
+                return
+            for offset, r in enumerate(new):
+                r["sheet_row"] = start_row + offset
+            self._mark_synced(new)
+
+    def _mark_synced(self, rows: list[dict]):
+        # если счётчик успел вырасти после чтения — строка останется dirty
+        self.store.execute_many(
+            "UPDATE daily_stats SET sheet_row = ?, dirty = CASE WHEN count = ? THEN 0 ELSE 1 END WHERE "
+            + " AND ".join(f"{c} = ?" for c in DAILY_STATS_KEY),
+            [(r["sheet_row"], r["count"], *(r[c] for c in DAILY_STATS_KEY)) for r in rows],
+        )
+
+
+DAILY_STATS_SYNC = DailyStatsSheetSync(STORE)
+
+# ===== помесячные вкладки actions =====
+
+
+def actions_partition_name(ts_iso: str) -> str:
+    """'2026-10-18T...' -> 'actions_2026_10'."""
+    return f"{ACTIONS_SHEET_NAME}_{ts_iso[:4]}_{ts_iso[5:7]}"
+
+
+def _months_ago_start(months: int) -> datetime:
+    """Начало месяца, отстоящего на months назад от текущего (UTC)."""
+    now = datetime.now(UTC)
+    total = now.year * 12 + (now.month - 1) - months
+    return datetime(total // 12, total % 12 + 1, 1, tzinfo=UTC)
+
+
+class ActionsPartitions:
+    """Лог действий в Sheets разложен по месяцам: actions_2026_10, actions_2026_11, ...
+
+    Репликатор пишет каждую строку во вкладку её месяца, новая вкладка создаётся
+    при первой строке месяца. Старая вкладка actions остаётся архивом и больше не растёт.
+    """
+
+    NAME_RE = re.compile(rf"^{ACTIONS_SHEET_NAME}_\d{{4}}_\d{{2}}$")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sheet = None
+        self._raw: dict[str, object] = {}  # имя -> gspread.Worksheet
+        self._worksheets: dict[str, QuotaWorksheet] = {}  # имя -> обёртка с квотами
+
+    def bind(self, sheet):
+        if sheet is None:
+            return
+        worksheets = SHEETS_QUOTA.call("read", sheet.worksheets)
+        with self._lock:
+            self._sheet = sheet
+            for ws in worksheets:
+                if self.NAME_RE.match(ws.title):
+                    self._raw[ws.title] = ws
+                    self._worksheets[ws.title] = QuotaWorksheet(ws)
+        print(f">>> ActionsPartitions: помесячных вкладок {len(self._raw)}")
+
+    def names(self) -> list[str]:
+        with self._lock:
+            return sorted(self._worksheets)
+
+    def for_record(self, record: dict):
+        """Вкладка для строки лога (по месяцу ts_iso), при необходимости создаём её."""
+        ts_iso = record.get("ts_iso") or datetime.now(UTC).isoformat(timespec="seconds")
+        return self.get(actions_partition_name(ts_iso))
+
+    def get(self, name: str, create: bool = True):
+        with self._lock:
+            ws = self._worksheets.get(name)
+            if ws is not None or not create or self._sheet is None:
+                return ws
+            raw = SHEETS_QUOTA.call(
+                "write", self._sheet.add_worksheet,
+                title=name, rows=1000, cols=len(STORE_TABLES[ACTIONS_SHEET_NAME]),
+            )
+            ws = QuotaWorksheet(raw)
+            ws.append_row(STORE_TABLES[ACTIONS_SHEET_NAME], value_input_option="RAW")
+            self._raw[name] = raw
+            self._worksheets[name] = ws
+        print(f">>> ActionsPartitions: создана вкладка '{name}'")
+        return ws
+
+    def drop_before(self, name: str) -> list[str]:
+        """Удаляем вкладки месяцев раньше name."""
+        with self._lock:
+            old = sorted(n for n in self._raw if n < name)
+        dropped = []
+        for n in old:
+            try:
+                SHEETS_QUOTA.call("write", self._sheet.del_worksheet, self._raw[n])
+            except Exception as e:
+                print(f">>> ActionsPartitions: не удалось удалить '{n}': {e}")
+                continue
+            with self._lock:
+                self._raw.pop(n, None)
+                self._worksheets.pop(n, None)
+            dropped.append(n)
+        return dropped
+
+
+ACTIONS_PARTITIONS = ActionsPartitions()
+
+
+def compact_actions() -> str:
+    """Месяцы старше ACTIONS_KEEP_MONTHS остаются только дневными агрегатами.
+
+    Удаляем их строки из базы и вкладки actions_YYYY_MM, но только когда
+    агрегаты за эти дни уже записаны во вкладку daily_stats.
+    """
+    cutoff = _months_ago_start(ACTIONS_KEEP_MONTHS - 1)
+    cutoff_day = cutoff.date().isoformat()
+    if DAILY_STATS_SYNC.ws is None:
+        return "вкладка daily_stats не подключена — сжатие пропущено"
+    REPLICATOR.flush()
+    if STORE.query("SELECT 1 FROM daily_stats WHERE dirty = 1 AND day < ? LIMIT 1", (cutoff_day,)):
+        return "агрегаты ещё не записаны в daily_stats — сжатие пропущено"
+
+    removed = STORE.execute(
+        f"DELETE FROM {ACTIONS_SHEET_NAME} WHERE ts_iso < ? AND id <= ?",
+        (cutoff_day, STORE.get_cursor(ACTIONS_SHEET_NAME)),
+    )
+    if removed:
+        ACTIONS_CACHE.invalidate(drop=True)
+    dropped = ACTIONS_PARTITIONS.drop_before(actions_partition_name(cutoff.isoformat()))
+    return f"до {cutoff_day}: удалено строк {removed}, вкладок {len(dropped)}"
+
+
+def store_rows(table: str, rows: list[list]):
+    """Пишем строки в локальную базу и в кэш; в Sheets их отправит репликатор."""
+    try:
+        records = STORE.insert_many(table, rows)
+    except Exception as e:
+        print(f">>> store_rows({table}) error: {e}")
         return
+    REPLICATOR.notify(table, len(records))
+    cache = ROW_CACHES.get(table)
+    if cache is not None:
+        cache.write_through(records)
+
+
+def import_sheets_to_store():
+    """Если локальная база пустая (например, новый диск после деплоя) — заливаем историю из Sheets.
+
+    Импортированные строки уже есть во вкладках, поэтому курсор репликации
+    ставим на конец таблицы.
+    """
+    # actions: архивная вкладка и помесячные, которые ещё не сжаты
+    sources = {
+        USERS_SHEET_NAME: [GS_USERS_WS],
+        ACTIONS_SHEET_NAME: [GS_ACTIONS_WS] + [
+            ACTIONS_PARTITIONS.get(name, create=False) for name in ACTIONS_PARTITIONS.names()
+        ],
+        NURTURE_SHEET_NAME: [GS_NURTURE_WS],
+        AUTO_NURTURE_SHEET_NAME: [GS_AUTO_NURTURE_WS],
+        AUTO_NURTURE_TEXTS_SHEET_NAME: [GS_AUTO_NURTURE_TEXTS_WS],
+    }
+    for table, worksheets in sources.items():
+        if STORE.count(table) > 0:
+            continue
+        for ws in worksheets:
+            if ws is not None:
+                _import_worksheet(table, ws)
+        STORE.set_cursor(table, STORE.max_id(table))
+
+
+def _import_worksheet(table: str, ws):
+    """Заливаем в базу строки одной вкладки (колонки ищем по заголовку)."""
+    columns = STORE_TABLES[table]
+    try:
+        values = ws.get_all_values()
+    except Exception as e:
+        print(f">>> import_sheets_to_store: ошибка чтения '{ws.title}': {e}")
+        return
+    if not values:
+        return
+
+    if table == AUTO_NURTURE_SHEET_NAME:
+        # строка 1 — настройки авторассылки, история со строки 2, колонки по позициям
+        positions = list(range(len(columns)))
+    else:
+        header = values[0]
+        positions = [header.index(c) if c in header else None for c in columns]
+
+    rows = []
+    for row in values[1:]:
+        if not any(cell.strip() for cell in row):
+            continue
+        rows.append([
+            row[p].strip() if p is not None and p < len(row) else ""
+            for p in positions
+        ])
+    STORE.insert_many(table, rows)
+    print(f">>> import_sheets_to_store: '{ws.title}' — импортировано {len(rows)} строк")
+
+# ===== логирование событий =====
+
+
+def log_start_to_sheet(user, card_key: str | None):
+    """Лог входа пользователя (таблица users)."""
     date_iso = datetime.now(UTC).isoformat(timespec="seconds")
     row = [
         str(user.id),
@@ -241,16 +1209,12 @@ def log_start_to_sheet(user, card_key: str | None):
         date_iso,
         "unsub",
     ]
-    try:
-        GS_USERS_WS.append_row(row, value_input_option="RAW")
-    except Exception as e:
-        print(f">>> log_start_to_sheet error: {e}")
+    store_rows(USERS_SHEET_NAME, [row])
+    USER_TIMELINE.observe(_normalize_user_record(dict(zip(STORE_TABLES[USERS_SHEET_NAME], row))))
 
 
 def log_action_to_sheet(user, action: str, source: str = "unknown"):
-    """Лог действия пользователя в лист actions."""
-    if GS_ACTIONS_WS is None:
-        return
+    """Лог действия пользователя (таблица actions)."""
     ts_iso = datetime.now(UTC).isoformat(timespec="seconds")
     row = [
         str(user.id),
@@ -260,17 +1224,12 @@ def log_action_to_sheet(user, action: str, source: str = "unknown"):
         source,
         ts_iso,
     ]
-    try:
-        GS_ACTIONS_WS.append_row(row, value_input_option="RAW")
-    except Exception as e:
-        print(f">>> log_action_to_sheet error: {e}")
+    store_rows(ACTIONS_SHEET_NAME, [row])
 
 
 def log_nurture_to_sheet(user_id: int, card_key: str, segment: str,
                          day_num: int, status: str, error_msg: str = ""):
-    """Лог nurture-сообщения в лист nurture."""
-    if GS_NURTURE_WS is None:
-        return
+    """Лог nurture-сообщения (таблица nurture)."""
     sent_at = datetime.now(UTC).isoformat(timespec="seconds")
     row = [
         str(user_id),
@@ -282,17 +1241,12 @@ def log_nurture_to_sheet(user_id: int, card_key: str, segment: str,
         error_msg,
         "",  # subscribed_after
     ]
-    try:
-        GS_NURTURE_WS.append_row(row, value_input_option="RAW")
-    except Exception as e:
-        print(f">>> log_nurture_to_sheet error: {e}")
+    store_rows(NURTURE_SHEET_NAME, [row])
 
-# ===== чтение из Google Sheets =====
+# ===== чтение событий =====
 
 def log_card_of_day_publish(card_name: str, mode: str = "auto"):
-    """Логируем публикацию карты дня в Google Sheets."""
-    if GS_ACTIONS_WS is None:
-        return
+    """Логируем публикацию карты дня (таблица actions)."""
     ts_iso = datetime.now(UTC).isoformat(timespec="seconds")
     row = [
         "0",  # system
@@ -302,40 +1256,25 @@ def log_card_of_day_publish(card_name: str, mode: str = "auto"):
         mode,
         ts_iso,
     ]
-    try:
-        GS_ACTIONS_WS.append_row(row, value_input_option="RAW")
-    except Exception as e:
-        print(f">>> log_card_of_day_publish error: {e}")
+    store_rows(ACTIONS_SHEET_NAME, [row])
 
 def get_card_of_day_stats(days: int = 7) -> str:
     """Статистика по карте дня за последние N дней."""
-    rows = load_actions()
-    if not rows:
-        return esc_md2("Статистика карты дня пока пуста.")
-    
     now = datetime.now(UTC)
-    since = now - timedelta(days=days)
-    
-    card_publishes = []
-    for r in rows:
-        ts_iso = r.get("ts_iso", "").strip()
-        action = r.get("action", "").strip()
-        
-        if "card_of_day" not in action:
-            continue
-        
-        ts = parse_iso(ts_iso)
-        if ts is None or ts < since:
-            continue
-        
-        card_publishes.append(r)
+    since_day = (now - timedelta(days=days)).date().isoformat()
+
+    # считаем по дневным агрегатам, а не по строкам лога
+    by_source = defaultdict(int)
+    for r in STORE.daily_counts(ACTIONS_SHEET_NAME, since_day):
+        if "card_of_day" in r["action"]:
+            by_source[r["source"]] += r["count"]
     
-    if not card_publishes:
+    total = sum(by_source.values())
+    if not total:
         return esc_md2(f"За последние {days} дней карта дня не публиковалась.")
     
-    total = len(card_publishes)
-    auto_count = sum(1 for r in card_publishes if r.get("source") == "auto")
-    manual_count = sum(1 for r in card_publishes if r.get("source") == "manual")
+    auto_count = by_source.get("auto", 0)
+    manual_count = by_source.get("manual", 0)
     
     lines = []
     lines.append(esc_md2(f"Статистика карты дня за {days} дней"))
@@ -346,113 +1285,468 @@ def get_card_of_day_stats(days: int = 7) -> str:
     
     return "\n".join(lines)
 
-def load_users() -> list[dict]:
-    """Читаем всех пользователей из листа users."""
-    if GS_USERS_WS is None:
-        return []
+# Время строки разбираем один раз при загрузке: r["ts"] — секунды UTC (или None),
+# отчёты дальше сравнивают только числа.
+
+def _normalize_user_record(r: dict) -> dict:
+    r["user_id"] = str(r.get("user_id", "")).strip()
+    r["card_key"] = (r.get("card_key") or "").strip()
+    r["date_iso"] = (r.get("date_iso") or "").strip()
+    r["subscribed"] = (r.get("subscribed") or "").strip()
+    r["ts"] = iso_to_epoch(r["date_iso"])
+    return r
+
+
+def _normalize_action_record(r: dict) -> dict:
+    r["user_id"] = str(r.get("user_id", "")).strip()
+    r["action"] = (r.get("action") or "").strip()
+    r["source"] = (r.get("source") or "").strip()
+    r["ts_iso"] = (r.get("ts_iso") or "").strip()
+    r["username"] = (r.get("username") or "").strip()
+    r["first_name"] = (r.get("first_name") or "").strip()
+    r["ts"] = iso_to_epoch(r["ts_iso"])
+    return r
+
+
+def load_users(after_id: int = 0, since: str | None = None) -> list[dict]:
+    """Читаем пользователей из локальной базы (id > after_id, date_iso >= since)."""
     try:
-        records = GS_USERS_WS.get_all_records()
+        records = STORE.fetch(USERS_SHEET_NAME, after_id=after_id, since=since)
         # гарантируем строковые user_id
         for r in records:
-            r["user_id"] = str(r.get("user_id", "")).strip()
-            r["card_key"] = (r.get("card_key") or "").strip()
-            r["date_iso"] = (r.get("date_iso") or "").strip()
-            r["subscribed"] = (r.get("subscribed") or "").strip()
+            _normalize_user_record(r)
         return records
     except Exception as e:
-        print(f">>> load_users (Sheets) error: {e}")
+        print(f">>> load_users (SQLite) error: {e}")
         return []
 
 
-def load_actions() -> list[dict]:
-    """Читаем лог действий из листа actions."""
-    if GS_ACTIONS_WS is None:
-        return []
+def load_actions(after_id: int = 0, since: str | None = None) -> list[dict]:
+    """Читаем лог действий из локальной базы (id > after_id, ts_iso >= since)."""
     try:
-        records = GS_ACTIONS_WS.get_all_records()
+        records = STORE.fetch(ACTIONS_SHEET_NAME, after_id=after_id, since=since)
         for r in records:
-            r["user_id"] = str(r.get("user_id", "")).strip()
-            r["action"] = (r.get("action") or "").strip()
-            r["source"] = (r.get("source") or "").strip()
-            r["ts_iso"] = (r.get("ts_iso") or "").strip()
-            r["username"] = (r.get("username") or "").strip()
-            r["first_name"] = (r.get("first_name") or "").strip()
+            _normalize_action_record(r)
         return records
     except Exception as e:
-        print(f">>> load_actions (Sheets) error: {e}")
+        print(f">>> load_actions (SQLite) error: {e}")
         return []
 
+# ===== обновление статуса подписки =====
 
-def load_nurture_rows() -> list[dict]:
-    """Читаем nurture-лог из листа nurture."""
-    if GS_NURTURE_WS is None:
-        return []
-    try:
-        records = GS_NURTURE_WS.get_all_records()
-        for r in records:
-            r["user_id"] = str(r.get("user_id", "")).strip()
-            r["card_key"] = (r.get("card_key") or "").strip()
-            r["segment"] = (r.get("segment") or "").strip()
-            r["day_num"] = str(r.get("day_num", "")).strip()
-            r["sent_at"] = (r.get("sent_at") or "").strip()
-            r["status"] = (r.get("status") or "").strip()
-            r["error_msg"] = (r.get("error_msg") or "").strip()
-            r["subscribed_after"] = (r.get("subscribed_after") or "").strip()
-        return records
-    except Exception as e:
-        print(f">>> load_nurture_rows (Sheets) error: {e}")
-        return []
 
-# ===== обновление статуса подписки в Sheets =====
+class UsersSheetIndex:
+    """Индекс листа users: user_id -> номера строк и текущее значение subscribed.
+
+    Строится одним get_all_values, дальше пополняется строками, которые
+    дописывает SheetsReplicator, и перестраивается раз в ttl секунд
+    (на случай ручных правок таблицы).
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._rows: dict[str, set[int]] = {}  # user_id -> номера строк (с 1)
+        self._sub_values: dict[int, str] = {}  # номер строки -> subscribed
+        self._idx_id: int | None = None
+        self._idx_sub: int | None = None
+        self._built_at = 0.0
+
+    def rebuild(self, ws) -> bool:
+        with self._lock:
+            all_values = ws.get_all_values()
+            if not all_values:
+                return False
+            header = all_values[0]
+            try:
+                idx_id = header.index("user_id")
+                idx_sub = header.index("subscribed")
+            except ValueError:
+                print(">>> UsersSheetIndex: нет нужных столбцов в users")
+                return False
+
+            rows: dict[str, set[int]] = {}
+            sub_values: dict[int, str] = {}
+            for i in range(1, len(all_values)):
+                row = all_values[i]
+                if len(row) <= idx_id:
+                    continue
+                uid = row[idx_id].strip()
+                if not uid:
+                    continue
+                rows.setdefault(uid, set()).add(i + 1)
+                sub_values[i + 1] = row[idx_sub].strip() if len(row) > idx_sub else ""
+
+            self._rows = rows
+            self._sub_values = sub_values
+            self._idx_id = idx_id
+            self._idx_sub = idx_sub
+            self._built_at = time_module.time()
+            print(f">>> UsersSheetIndex: {len(rows)} пользователей, {len(sub_values)} строк")
+            return True
+
+    def _ensure(self, ws) -> bool:
+        if self._idx_sub is not None and time_module.time() - self._built_at < self.ttl:
+            return True
+        return self.rebuild(ws)
+
+    def on_rows_appended(self, start_row: int, rows: list[list]):
+        """Колбэк SheetsReplicator: строки дописаны в users начиная с start_row."""
+        with self._lock:
+            if self._idx_id is None:
+                return
+            for offset, row in enumerate(rows):
+                if len(row) <= self._idx_id:
+                    continue
+                uid = str(row[self._idx_id]).strip()
+                if not uid:
+                    continue
+                row_num = start_row + offset
+                self._rows.setdefault(uid, set()).add(row_num)
+                self._sub_values[row_num] = str(row[self._idx_sub]).strip() if len(row) > self._idx_sub else ""
+
+    def set_subscribed_flags(self, ws, flags: dict) -> int:
+        """Пишем только изменившиеся ячейки subscribed одним batch_update."""
+        with self._lock:
+            if not self._ensure(ws):
+                return 0
+
+            updates = []
+            changed: dict[int, str] = {}
+            for uid, is_sub in flags.items():
+                val = "sub" if is_sub else "unsub"
+                for row_num in sorted(self._rows.get(str(uid), ())):
+                    if self._sub_values.get(row_num) == val:
+                        continue
+                    updates.append({
+                        "range": gspread.utils.rowcol_to_a1(row_num, self._idx_sub + 1),
+                        "values": [[val]],
+                    })
+                    changed[row_num] = val
+
+            if not updates:
+                return 0
+            try:
+                ws.batch_update(updates, value_input_option="RAW")
+            except Exception:
+                # неизвестно, что успело записаться — перечитаем лист в следующий раз
+                self._built_at = 0.0
+                raise
+            self._sub_values.update(changed)
+            return len(updates)
+
 
+USERS_INDEX = UsersSheetIndex(USERS_INDEX_TTL)
 
-def update_subscribed_flag(user_id: int, is_sub: bool):
-    """Обновляем поле subscribed для всех строк этого user_id в листе users."""
+
+def set_subscribed_flags(flags: dict) -> int:
+    """Проставляем subscribed для пачки пользователей {user_id: is_sub}.
+
+    В локальной базе — одним executemany, в листе users — одним batch_update.
+    """
+    if not flags:
+        return 0
+    try:
+        STORE.set_subscribed(flags)
+    except Exception as e:
+        print(f">>> set_subscribed_flags (SQLite) error: {e}")
+    USER_TIMELINE.set_status(flags)
     if GS_USERS_WS is None:
-        return
+        return 0
     try:
-        all_values = GS_USERS_WS.get_all_values()
-        if not all_values:
-            return
+        count = USERS_INDEX.set_subscribed_flags(GS_USERS_WS, flags)
+        if count:
+            print(f">>> set_subscribed_flags: обновлено {count} ячеек для {len(flags)} пользователей")
+        return count
+    except Exception as e:
+        print(f">>> set_subscribed_flags (Sheets) error: {e}")
+        return 0
 
-        header = all_values[0]
+# ===== КЭШ RAM =====
+
+
+class RowCache:
+    """Кэш строк таблицы users / actions.
+
+    - обновление дочитывает из базы только строки с id больше прочитанных;
+    - single-flight: при промахе все одновременные запросы ждут одно чтение;
+    - stale-while-revalidate: устаревшие данные отдаём сразу, а обновляем
+      их в фоновом потоке;
+    - write-through: строки, записанные через store_rows, видны сразу;
+    - строки разложены по дням UTC (по r["ts"]), rows_between() читает
+      только дни нужного периода;
+    - invalidate() помечает кэш устаревшим, invalidate(drop=True) сбрасывает его.
+    """
+
+    def __init__(self, name: str, loader, normalize, ttl: float):
+        self.name = name
+        self.loader = loader
+        self.normalize = normalize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rows: list[dict] | None = None
+        self._by_day: dict[int, list[dict]] = {}  # номер дня UTC (ts // 86400) → строки
+        self._synced_id = 0  # все строки с id <= этого уже дочитаны из базы
+        self._written_ids: set[int] = set()  # write-through строки новее _synced_id
+        self._loaded_at = 0.0
+        self._inflight: Future | None = None
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.last_refresh_ms = 0.0
+        self.total_refresh_ms = 0.0
+
+    def get(self) -> list[dict]:
+        """Строки таблицы; список общий, менять его снаружи нельзя."""
+        with self._lock:
+            if self._rows is not None:
+                if time_module.time() - self._loaded_at <= self.ttl:
+                    self.hits += 1
+                else:
+                    self.stale_hits += 1
+                    if self._inflight is None:
+                        self._inflight = Future()
+                        threading.Thread(
+                            target=self._refresh, args=(self._inflight,),
+                            name=f"cache-{self.name}", daemon=True,
+                        ).start()
+                return self._rows
+
+            self.misses += 1
+            future = self._inflight
+            is_owner = future is None
+            if is_owner:
+                future = self._inflight = Future()
+
+        if is_owner:
+            self._refresh(future)
         try:
-            idx_id = header.index("user_id")
-            idx_sub = header.index("subscribed")
-        except ValueError:
-            print(">>> update_subscribed_flag: нет нужных столбцов в users")
-            return
+            future.result()
+        except Exception:
+            pass
+        with self._lock:
+            return self._rows if self._rows is not None else []
+
+    def rows_between(self, start_ts: float, end_ts: float) -> list[dict]:
+        """Строки с start_ts <= ts <= end_ts; перебираем только дни периода."""
+        self.get()  # загрузка / фоновое обновление по тем же правилам
+        first_day, last_day = int(start_ts // 86400), int(end_ts // 86400)
+        result = []
+        with self._lock:
+            if len(self._by_day) < last_day - first_day + 1:
+                days = sorted(d for d in self._by_day if first_day <= d <= last_day)
+            else:
+                days = range(first_day, last_day + 1)
+            for day in days:
+                for row in self._by_day.get(day, ()):
+                    if start_ts <= row["ts"] <= end_ts:
+                        result.append(row)
+        return result
+
+    def _add(self, row: dict):
+        """Добавляем строку в список и в дневную корзину (под self._lock)."""
+        self._rows.append(row)
+        ts = row.get("ts")
+        if ts is not None:
+            self._by_day.setdefault(int(ts // 86400), []).append(row)
+
+    def _refresh(self, future: Future):
+        started = time_module.perf_counter()
+        try:
+            with self._lock:
+                after_id = self._synced_id
+            new_rows = self.loader(after_id=after_id)
+            with self._lock:
+                if self._rows is None:
+                    self._rows = []
+                for row in new_rows:
+                    if row["id"] not in self._written_ids:
+                        self._add(row)
+                if new_rows:
+                    self._synced_id = new_rows[-1]["id"]
+                    self._written_ids = {i for i in self._written_ids if i > self._synced_id}
+                self._loaded_at = time_module.time()
+                elapsed_ms = (time_module.perf_counter() - started) * 1000
+                self.refreshes += 1
+                self.last_refresh_ms = elapsed_ms
+                self.total_refresh_ms += elapsed_ms
+            print(f"🔄 Кэш {self.name} обновлён (+{len(new_rows)}, {elapsed_ms:.0f} мс)")
+            future.set_result(None)
+        except Exception as e:
+            with self._lock:
+                self.refresh_errors += 1
+            print(f">>> RowCache({self.name}) refresh error: {e}")
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                if self._inflight is future:
+                    self._inflight = None
+
+    def write_through(self, records: list[dict]):
+        """Добавляем только что записанные строки, не дожидаясь обновления."""
+        with self._lock:
+            if self._rows is None:
+                return  # кэш ещё не загружен — строки придут с первым чтением
+            for record in records:
+                # строку уже мог дочитать параллельный _refresh — второй раз не добавляем
+                if record["id"] <= self._synced_id or record["id"] in self._written_ids:
+                    continue
+                self._add(self.normalize(dict(record)))
+                self._written_ids.add(record["id"])
+
+    def invalidate(self, drop: bool = False):
+        with self._lock:
+            self._loaded_at = 0.0
+            if drop:
+                self._rows = None
+                self._by_day = {}
+                self._synced_id = 0
+                self._written_ids = set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rows": len(self._rows) if self._rows is not None else 0,
+                "age": time_module.time() - self._loaded_at if self._rows is not None else None,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "refresh_errors": self.refresh_errors,
+                "last_refresh_ms": self.last_refresh_ms,
+                "avg_refresh_ms": self.total_refresh_ms / self.refreshes if self.refreshes else 0.0,
+            }
 
-        target_id = str(user_id)
-        for i in range(1, len(all_values)):
-            row = all_values[i]
-            if len(row) <= max(idx_id, idx_sub):
-                continue
-            if row[idx_id].strip() == target_id:
-                row[idx_sub] = "sub" if is_sub else "unsub"
-                GS_USERS_WS.update_cell(i + 1, idx_sub + 1, row[idx_sub])
-    except Exception as e:
-        print(f">>> update_subscribed_flag (Sheets) error: {e}")
 
-# ===== КЭШ RAM =====
+USERS_CACHE = RowCache(USERS_SHEET_NAME, load_users, _normalize_user_record, CACHE_TTL)
+ACTIONS_CACHE = RowCache(ACTIONS_SHEET_NAME, load_actions, _normalize_action_record, CACHE_TTL)
+ROW_CACHES = {
+    USERS_SHEET_NAME: USERS_CACHE,
+    ACTIONS_SHEET_NAME: ACTIONS_CACHE,
+}
+
 
 def get_cached_users():
-    import time as t  # ФИКС конфликта!
-    now = t.time()
-    if now - USERS_CACHE['timestamp'] > CACHE_TTL:
-        print("🔄 Кэш users обновлён")
-        USERS_CACHE['data'] = load_users()
-        USERS_CACHE['timestamp'] = now
-    return USERS_CACHE['data']
+    return USERS_CACHE.get()
 
 def get_cached_actions():
-    import time as t  # ФИКС конфликта!
-    now = t.time()
-    if now - ACTIONS_CACHE['timestamp'] > CACHE_TTL:
-        print("🔄 Кэш actions обновлён")
-        ACTIONS_CACHE['data'] = load_actions()
-        ACTIONS_CACHE['timestamp'] = now
-    return ACTIONS_CACHE['data']
+    return ACTIONS_CACHE.get()
+
+
+def build_cache_stats() -> str:
+    """Счётчики кэшей для админки."""
+    lines = ["🗄 Кэш строк", ""]
+    for cache in ROW_CACHES.values():
+        st = cache.stats()
+        age = f"{st['age']:.0f} с" if st["age"] is not None else "не загружен"
+        lines.append(f"{cache.name}: строк {st['rows']}, возраст {age}")
+        lines.append(
+            f"  попаданий {st['hits']}, устаревших {st['stale_hits']}, промахов {st['misses']}"
+        )
+        lines.append(
+            f"  обновлений {st['refreshes']} (ошибок {st['refresh_errors']}), "
+            f"последнее {st['last_refresh_ms']:.0f} мс, среднее {st['avg_refresh_ms']:.0f} мс"
+        )
+        lines.append("")
+    return "\n".join(lines).rstrip()
+
+# ===== индекс пользователей: первый/последний вход, карта, подписка =====
+
+
+class UserTimelineIndex:
+    """Сводка по каждому пользователю: первый и последний вход, карта последнего входа,
+    username / first_name и статус подписки.
+
+    Строится один раз из таблицы users, дальше обновляется на месте:
+    новые входы — из log_start_to_sheet, статус — из set_subscribed_flags.
+    Отчёты получают готовую сводку за O(пользователей), без разбора строк.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users: dict[str, dict] = {}
+        self._loaded = False
+
+    def ensure_loaded(self):
+        if self._loaded:
+            return
+        rows = load_users()
+        with self._lock:
+            for row in rows:
+                self._observe(row)
+            self._loaded = True
+        print(f">>> UserTimelineIndex: {len(self._users)} пользователей")
+
+    def observe(self, row: dict):
+        """Учитываем новую строку users (повторный учёт той же строки ничего не меняет)."""
+        with self._lock:
+            if self._loaded:
+                self._observe(row)
+
+    def _observe(self, row: dict):
+        uid = row.get("user_id", "")
+        ts = row.get("ts")
+        if not uid or ts is None:
+            return
+        info = self._users.get(uid)
+        if info is None:
+            dt = datetime.fromtimestamp(ts, UTC)
+            self._users[uid] = {
+                "username": row.get("username", ""),
+                "first_name": row.get("first_name", ""),
+                "first_ts": ts,
+                "last_ts": ts,
+                "first_dt": dt,
+                "last_dt": dt,
+                "card_key": row.get("card_key", ""),
+                "subscribed": row.get("subscribed") or "unsub",
+            }
+            return
+        if ts < info["first_ts"]:
+            info["first_ts"] = ts
+            info["first_dt"] = datetime.fromtimestamp(ts, UTC)
+        if ts >= info["last_ts"]:
+            info["last_ts"] = ts
+            info["last_dt"] = datetime.fromtimestamp(ts, UTC)
+            info["card_key"] = row.get("card_key", "")
+            info["username"] = row.get("username") or info["username"]
+            info["first_name"] = row.get("first_name") or info["first_name"]
+        # у новых строк subscribed всегда "unsub" — статус меняет только set_status
+
+    def set_status(self, flags: dict):
+        with self._lock:
+            for uid, is_sub in flags.items():
+                info = self._users.get(str(uid))
+                if info is not None:
+                    info["subscribed"] = "sub" if is_sub else "unsub"
+
+    def snapshot(self) -> dict[str, dict]:
+        """Копия сводки {user_id: {...}} для отчёта."""
+        self.ensure_loaded()
+        with self._lock:
+            return {uid: dict(info) for uid, info in self._users.items()}
+
+    def profiles(self, user_ids) -> dict[str, dict]:
+        """username / first_name для указанных user_id."""
+        self.ensure_loaded()
+        with self._lock:
+            return {
+                uid: {"username": info["username"], "first_name": info["first_name"]}
+                for uid in user_ids
+                if (info := self._users.get(uid)) is not None
+            }
+
+    def active_since(self, since: datetime) -> set[str]:
+        """Пользователи, у которых был вход позже since."""
+        self.ensure_loaded()
+        since_ts = since.timestamp()
+        with self._lock:
+            return {uid for uid, info in self._users.items() if info["last_ts"] > since_ts}
+
+
+USER_TIMELINE = UserTimelineIndex()
 
 # ===== лимиты попыток на день =====
 
@@ -512,6 +1806,300 @@ def get_pack_description(code: str) -> tuple[str, str, str]:
 
 # ===== отправка картинок =====
 
+MEDIA_DIRS = (META_CARDS_DIR, DICE_DIR, PACKS_DIR, CARD_OF_DAY_DIR)
+MEDIA_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# случайные карты и кубики тянем, как и раньше, только из jpg (png в этих папках — не колода)
+DRAW_EXTENSIONS = (".jpg", ".jpeg")
+
+
+class AssetRegistry:
+    """Картинки из папок бота: готовые списки файлов и их метаданные в памяти.
+
+    Папка сканируется при старте и заново — только если изменился её mtime
+    (файл добавили, удалили, переименовали); mtime сверяется не чаще раза
+    в recheck секунд. Файлы, имя которых начинается с "_", не выдаются —
+    так карту можно убрать из колоды, не удаляя её. choice() выбирает
+    только из DRAW_EXTENSIONS, get() находит любой файл из MEDIA_EXTENSIONS.
+    """
+
+    def __init__(self, directories, recheck: float):
+        self.directories = tuple(directories)
+        self.recheck = recheck
+        self._lock = threading.Lock()
+        # папка -> {"mtime_ns", "checked_at", "files": (meta, ...), "draw": (meta, ...), "by_name": {name: meta}}
+        self._dirs: dict[str, dict] = {}
+
+    @staticmethod
+    def _scan(directory: str, mtime_ns: int) -> dict:
+        files = []
+        for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+            name = entry.name
+            if name.startswith(("_", ".")) or not name.lower().endswith(MEDIA_EXTENSIONS):
+                continue
+            st = entry.stat()
+            files.append({"path": entry.path, "name": name, "size": st.st_size, "mtime_ns": st.st_mtime_ns})
+        print(f">>> AssetRegistry: {os.path.basename(directory)} — {len(files)} файлов")
+        return {
+            "mtime_ns": mtime_ns,
+            "checked_at": time_module.monotonic(),
+            "files": tuple(files),
+            "draw": tuple(f for f in files if f["name"].lower().endswith(DRAW_EXTENSIONS)),
+            "by_name": {f["name"]: f for f in files},
+        }
+
+    def _entry(self, directory: str) -> dict:
+        entry = self._dirs.get(directory)
+        now = time_module.monotonic()
+        if entry is not None and now - entry["checked_at"] < self.recheck:
+            return entry
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        with self._lock:
+            entry = self._dirs.get(directory)
+            if entry is not None and entry["mtime_ns"] == mtime_ns:
+                entry["checked_at"] = now
+            elif mtime_ns is None:
+                entry = {"mtime_ns": None, "checked_at": now, "files": (), "draw": (), "by_name": {}}
+            else:
+                entry = self._scan(directory, mtime_ns)
+            self._dirs[directory] = entry
+            return entry
+
+    def load(self):
+        for directory in self.directories:
+            self._entry(directory)
+
+    def files(self, directory: str) -> tuple[dict, ...]:
+        return self._entry(directory)["files"]
+
+    def choice(self, directory: str) -> dict | None:
+        """Случайная картинка из папки (None, если папка пуста)."""
+        files = self._entry(directory)["draw"]
+        return random.choice(files) if files else None
+
+    def get(self, directory: str, name: str) -> dict | None:
+        return self._entry(directory)["by_name"].get(name)
+
+    def all_paths(self) -> list[str]:
+        return [f["path"] for directory in self.directories for f in self.files(directory)]
+
+
+ASSETS = AssetRegistry(MEDIA_DIRS, ASSET_RECHECK_INTERVAL)
+
+
+class ImageDerivatives:
+    """Копии картинок под Telegram: не больше max_side по большей стороне, JPEG quality.
+
+    Копия лежит в cache_dir под именем из хэша содержимого оригинала и параметров,
+    поэтому изменённый файл получает новую копию, а старую можно просто удалить.
+    Если Pillow нет, копию сделать не удалось или она не меньше оригинала —
+    отправляется оригинал.
+    """
+
+    def __init__(self, cache_dir: str, max_side: int, quality: int):
+        self.cache_dir = cache_dir
+        self.max_side = max_side
+        self.quality = quality
+        self._lock = threading.Lock()
+        self._known: dict[tuple, str] = {}  # (путь, mtime_ns, size) -> что отправлять
+
+    def path_for(self, path: str) -> str:
+        """Путь к файлу для загрузки в Telegram (копия или сам оригинал)."""
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+        result = self._known.get(key)
+        if result is not None and os.path.exists(result):
+            return result
+        try:
+            result = self._build(path)
+        except Exception as e:
+            print(f">>> ImageDerivatives: не удалось уменьшить {path}: {e}")
+            result = path
+        with self._lock:
+            self._known[key] = result
+        return result
+
+    def _build(self, path: str) -> str:
+        if Image is None:
+            return path
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data + f"|{self.max_side}|{self.quality}".encode()).hexdigest()
+        target = os.path.join(self.cache_dir, f"{digest}.jpg")
+        if not os.path.exists(target):
+            with Image.open(io.BytesIO(data)) as img:
+                # JPEG сразу декодируем в уменьшенном масштабе — в разы быстрее полного разбора
+                img.draft("RGB", (self.max_side, self.max_side))
+                img = ImageOps.exif_transpose(img)
+                if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+                    background = Image.new("RGB", img.size, "white")
+                    background.paste(img, mask=img.convert("RGBA").getchannel("A"))
+                    img = background
+                else:
+                    img = img.convert("RGB")
+                img.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = f"{target}.{threading.get_ident()}.tmp"
+                img.save(tmp_path, "JPEG", quality=self.quality, optimize=True, progressive=True)
+                os.replace(tmp_path, target)
+        return target if os.path.getsize(target) < len(data) else path
+
+    def build_all(self, paths) -> tuple[int, int]:
+        """Готовим копии заранее; возвращаем (уменьшено, оставлено как есть)."""
+        if Image is None:
+            print(">>> ImageDerivatives: Pillow не установлен — отправляем оригиналы")
+            return 0, 0
+        started = time_module.monotonic()
+        reduced = kept = 0
+        saved = 0
+        for path in paths:
+            result = self.path_for(path)
+            if result == path:
+                kept += 1
+            else:
+                reduced += 1
+                saved += os.path.getsize(path) - os.path.getsize(result)
+        print(f">>> ImageDerivatives: уменьшено {reduced}, оригиналов {kept}, "
+              f"экономия {saved // 1024} КБ за {time_module.monotonic() - started:.1f} с")
+        return reduced, kept
+
+
+IMAGE_DERIVATIVES = ImageDerivatives(IMAGE_CACHE_DIR, IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY)
+
+
+class MediaFileCache:
+    """Локальный файл -> file_id, который вернул Telegram после первой загрузки.
+
+    Ключ — путь относительно BASE_DIR, запись действительна, пока у файла
+    те же mtime и размер; поменяли картинку — она загрузится заново.
+    Хранится в SQLite, в памяти — словарь для проверки без запросов к базе.
+    """
+
+    def __init__(self, store: EventStore):
+        self.store = store
+        self._lock = threading.Lock()
+        store.execute(
+            "CREATE TABLE IF NOT EXISTS media_file_ids ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "file_id TEXT NOT NULL, updated_at TEXT NOT NULL)"
+        )
+        self._entries: dict[str, tuple[int, int, str]] = {
+            r["path"]: (r["mtime_ns"], r["size"], r["file_id"])
+            for r in store.query("SELECT path, mtime_ns, size, file_id FROM media_file_ids")
+        }
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return os.path.relpath(path, BASE_DIR)
+
+    def get(self, path: str) -> str | None:
+        """file_id для файла, если он не менялся с загрузки (FileNotFoundError, если файла нет)."""
+        st = os.stat(path)
+        entry = self._entries.get(self._key(path))
+        if entry is None or entry[:2] != (st.st_mtime_ns, st.st_size):
+            return None
+        return entry[2]
+
+    def put(self, path: str, file_id: str):
+        st = os.stat(path)
+        key = self._key(path)
+        with self._lock:
+            self._entries[key] = (st.st_mtime_ns, st.st_size, file_id)
+        self.store.execute(
+            "INSERT INTO media_file_ids (path, mtime_ns, size, file_id, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET mtime_ns = excluded.mtime_ns, size = excluded.size, "
+            "file_id = excluded.file_id, updated_at = excluded.updated_at",
+            (key, st.st_mtime_ns, st.st_size, file_id, datetime.now(UTC).isoformat(timespec="seconds")),
+        )
+
+    def forget(self, path: str):
+        key = self._key(path)
+        with self._lock:
+            self._entries.pop(key, None)
+        self.store.execute("DELETE FROM media_file_ids WHERE path = ?", (key,))
+
+
+MEDIA_CACHE = MediaFileCache(STORE)
+
+# BadRequest, после которых file_id из кэша уже не годится (остальные — ошибка самого запроса)
+FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file", "file reference", "can't use file of type")
+
+
+def _is_file_id_error(e: BadRequest) -> bool:
+    message = str(e).lower()
+    return any(marker in message for marker in FILE_ID_ERRORS)
+
+
+async def send_cached_photo(send, path: str, **kwargs):
+    """Отправляем локальную картинку: по file_id, если она уже загружалась, иначе файлом.
+
+    send — chat.send_photo / message.reply_photo / partial(bot.send_photo, chat_id=...).
+    """
+    file_id = MEDIA_CACHE.get(path)
+    if file_id:
+        try:
+            return await send(photo=file_id, **kwargs)
+        except BadRequest as e:
+            # file_id протух (например, другой токен бота) — загружаем файл заново;
+            # прочие BadRequest (подпись, разметка, чат) повторная загрузка не исправит
+            if not _is_file_id_error(e):
+                raise
+            print(f">>> MediaFileCache: file_id для {path} не принят: {e}")
+            await run_store(MEDIA_CACHE.forget, path)
+    upload_path = await asyncio.to_thread(IMAGE_DERIVATIVES.path_for, path)
+    try:
+        with open(upload_path, "rb") as f:
+            message = await send(photo=f, **kwargs)
+    except BadRequest as e:
+        if upload_path == path:
+            raise
+        # копию Telegram не принял — отправляем оригинал
+        print(f">>> ImageDerivatives: копия {upload_path} не принята: {e}")
+        with open(path, "rb") as f:
+            message = await send(photo=f, **kwargs)
+    if message is not None and message.photo:
+        await run_store(MEDIA_CACHE.put, path, message.photo[-1].file_id)
+    return message
+
+
+async def warm_media_cache(bot, chat_id: int, on_progress=None) -> dict:
+    """Загружаем в chat_id картинки, которых ещё нет в MEDIA_CACHE, и запоминаем их file_id.
+
+    Параллельно не больше MEDIA_WARMUP_CONCURRENCY загрузок под своим лимитером WARMUP_LIMITER;
+    служебные сообщения сразу удаляем. on_progress(result) — после каждой картинки.
+    """
+    paths = ASSETS.all_paths()
+    pending = [p for p in paths if MEDIA_CACHE.get(p) is None]
+    result = {"total": len(paths), "cached": len(paths) - len(pending), "uploaded": 0, "failed": 0}
+    send = functools.partial(bot.send_photo, disable_notification=True)
+    semaphore = asyncio.Semaphore(MEDIA_WARMUP_CONCURRENCY)
+
+    async def upload(path: str):
+        async with semaphore:
+            try:
+                message = await send_with_retry(
+                    lambda chat: send_cached_photo(functools.partial(send, chat_id=chat), path),
+                    chat_id, limiter=WARMUP_LIMITER,
+                )
+                result["uploaded"] += 1
+            except Exception as e:
+                print(f">>> warm_media_cache: {path}: {type(e).__name__} - {e}")
+                result["failed"] += 1
+                message = None
+            if on_progress is not None:
+                await on_progress(result)
+        if message is not None:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+            except Exception:
+                pass
+
+    await asyncio.gather(*(upload(p) for p in pending))
+    print(f">>> warm_media_cache: {result}")
+    return result
+
 
 async def send_random_meta_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
@@ -521,36 +2109,31 @@ async def send_random_meta_card(update: Update, context: ContextTypes.DEFAULT_TY
     if chat is None:
         return
 
-    files = []
-    for name in os.listdir(META_CARDS_DIR):
-        lower = name.lower()
-        if lower.endswith(".jpg") or lower.endswith(".jpeg"):
-            files.append(os.path.join(META_CARDS_DIR, name))
-
-    if not files:
+    card = ASSETS.choice(META_CARDS_DIR)
+    if card is None:
         await chat.send_message("Пока нет ни одной карты в папке meta_cards.")
         return
 
-    path = random.choice(files)
+    path = card["path"]
 
-    with open(path, "rb") as f:
-        try:
-            await chat.send_photo(
-                photo=f,
-                caption="🃏 Ваша метафорическая карта на сегодня",
-            )
-        except TimedOut:
-            await chat.send_message(
-                "Сейчас не получилось отправить карту (таймаут Telegram).\n"
-                "Попробуй, пожалуйста, ещё раз чуть позже."
-                "Для связи пиши мне в ЛС @Tatiataro18"
-            )
-        except Exception as e:
-            print(f"send_random_meta_card error: {e}")
-            await chat.send_message(
-                "Произошла ошибка при отправке карты. Попробуй ещё раз позже."
-                "Для связи пиши мне в ЛС @Tatiataro18"
-            )
+    try:
+        await send_cached_photo(
+            chat.send_photo,
+            path,
+            caption="🃏 Ваша метафорическая карта на сегодня",
+        )
+    except TimedOut:
+        await chat.send_message(
+            "Сейчас не получилось отправить карту (таймаут Telegram).\n"
+            "Попробуй, пожалуйста, ещё раз чуть позже."
+            "Для связи пиши мне в ЛС @Tatiataro18"
+        )
+    except Exception as e:
+        print(f"send_random_meta_card error: {e}")
+        await chat.send_message(
+            "Произошла ошибка при отправке карты. Попробуй ещё раз позже."
+            "Для связи пиши мне в ЛС @Tatiataro18"
+        )
 
 
 async def send_random_dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -561,36 +2144,31 @@ async def send_random_dice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat is None:
         return
 
-    files = []
-    for name in os.listdir(DICE_DIR):
-        lower = name.lower()
-        if lower.endswith(".jpg") or lower.endswith(".jpeg"):
-            files.append(os.path.join(DICE_DIR, name))
-
-    if not files:
+    dice = ASSETS.choice(DICE_DIR)
+    if dice is None:
         await chat.send_message("Кубик пока не положили в папку dice.")
         return
 
-    path = random.choice(files)
+    path = dice["path"]
 
-    with open(path, "rb") as f:
-        try:
-            await chat.send_photo(
-                photo=f,
-                caption="🎲 Ответ кубика:",
-            )
-        except TimedOut:
-            await chat.send_message(
-                "Сейчас не получилось отправить картинку кубика (таймаут Telegram).\n"
-                "Попробуй, пожалуйста, ещё раз чуть позже."
-                "Для связи пиши мне в ЛС @Tatiataro18"
-            )
-        except Exception as e:
-            print(f"send_random_dice error: {e}")
-            await chat.send_message(
-                "Произошла ошибка при отправке кубика. Попробуй ещё раз позже."
-                "Для связи пиши мне в ЛС @Tatiataro18"
-            )
+    try:
+        await send_cached_photo(
+            chat.send_photo,
+            path,
+            caption="🎲 Ответ кубика:",
+        )
+    except TimedOut:
+        await chat.send_message(
+            "Сейчас не получилось отправить картинку кубика (таймаут Telegram).\n"
+            "Попробуй, пожалуйста, ещё раз чуть позже."
+            "Для связи пиши мне в ЛС @Tatiataro18"
+        )
+    except Exception as e:
+        print(f"send_random_dice error: {e}")
+        await chat.send_message(
+            "Произошла ошибка при отправке кубика. Попробуй ещё раз позже."
+            "Для связи пиши мне в ЛС @Tatiataro18"
+        )
 
 # ===== nurture: подсчёт subscribed_after в Sheets =====
 
@@ -622,172 +2200,744 @@ def load_card_of_the_day() -> dict | None:
         print(f">>> load_card_of_the_day error: {e}")
         return None
 
-# --- НОВАЯ ФУНКЦИЯ ДЛЯ РАССЫЛКИ ---
-async def broadcast_message_to_users(bot, user_list, message_text):
-    """
-    Выполняет рассылку сообщения указанному списку пользователей.
+# ===== недоступные получатели =====
+
+
+def is_dead_chat_error(e: Exception) -> bool:
+    """Бот заблокирован, аккаунт удалён или чата нет — слать туда бесполезно."""
+    if isinstance(e, Forbidden):
+        return True
+    return isinstance(e, BadRequest) and "chat not found" in str(e).lower()
+
+
+class BlockedUsers:
+    """Пользователи, до которых сообщения не доходят (Forbidden / chat not found).
+
+    Хранится в SQLite, в памяти — множество id для быстрой фильтрации.
+    Все рассылки и джобы выкидывают таких из списка получателей;
+    из реестра пользователь выходит, только когда сам снова нажмёт /start.
+    """
+
+    def __init__(self, store: EventStore):
+        self.store = store
+        self._lock = threading.Lock()
+        store.execute(
+            "CREATE TABLE IF NOT EXISTS blocked_users ("
+            "user_id TEXT PRIMARY KEY, error TEXT NOT NULL DEFAULT '', "
+            "first_error_at TEXT NOT NULL, last_error_at TEXT NOT NULL)"
+        )
+        self._ids = {r["user_id"] for r in store.query("SELECT user_id FROM blocked_users")}
+
+    def is_blocked(self, user_id) -> bool:
+        return str(user_id) in self._ids
+
+    def filter(self, user_ids) -> list:
+        """Убираем заблокированных, порядок и тип id сохраняем."""
+        ids = self._ids
+        return [uid for uid in user_ids if str(uid) not in ids]
+
+    def mark(self, user_id, error: Exception):
+        now_iso = datetime.now(UTC).isoformat(timespec="seconds")
+        self.store.execute(
+            "INSERT INTO blocked_users (user_id, error, first_error_at, last_error_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET error = excluded.error, last_error_at = excluded.last_error_at",
+            (str(user_id), f"{type(error).__name__} - {error}", now_iso, now_iso),
+        )
+        with self._lock:
+            self._ids = self._ids | {str(user_id)}
+
+    def unblock(self, user_id):
+        if str(user_id) not in self._ids:
+            return
+        self.store.execute("DELETE FROM blocked_users WHERE user_id = ?", (str(user_id),))
+        with self._lock:
+            self._ids = self._ids - {str(user_id)}
+        print(f">>> BlockedUsers: {user_id} снова с нами (/start)")
+
+    def count(self) -> int:
+        return len(self._ids)
+
+
+BLOCKED_USERS = BlockedUsers(STORE)
+
+# ===== движок рассылок =====
+
+
+class BroadcastRateLimiter:
+    """Общий темп отправки на весь бот (rate сообщений в секунду)
+    и не чаще одного сообщения в секунду в один чат.
+
+    После RetryAfter от Telegram пауза действует на все рассылки сразу.
+    """
+
+    def __init__(self, rate: float, per_chat_interval: float = 1.0):
+        self.interval = 1.0 / rate
+        self.per_chat_interval = per_chat_interval
+        self._next = 0.0
+        self._paused_until = 0.0
+        self._chat_next: dict[int, float] = {}
+        self._lock = asyncio.Lock()
+
+    async def wait(self, chat_id: int):
+        async with self._lock:
+            now = time_module.monotonic()
+            slot = max(now, self._next, self._paused_until)
+            self._next = slot + self.interval
+            slot = max(slot, self._chat_next.get(chat_id, 0.0))
+            self._chat_next[chat_id] = slot + self.per_chat_interval
+            if len(self._chat_next) > 10000:
+                self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+        delay = slot - time_module.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time_module.monotonic() + seconds)
+
+
+BROADCAST_LIMITER = BroadcastRateLimiter(BROADCAST_RATE)
+# Прогрев file_id — свой лимитер: его RetryAfter не ставит на паузу рассылки пользователям
+WARMUP_LIMITER = BroadcastRateLimiter(1 / MEDIA_WARMUP_INTERVAL, per_chat_interval=MEDIA_WARMUP_INTERVAL)
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    value = e.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+class BroadcastStats:
+    """Итоги рассылки: сколько отправлено, сколько ошибок и какие."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.unknown = 0  # прервано перезапуском посреди отправки — повторно не шлём
+        self.failures: list[tuple[int, str]] = []  # (user_id, "Тип - текст")
+        self.started_at = time_module.monotonic()
+        self.finished_at: float | None = None
+        # отставание от расписания (для рассылок с окном), секунды
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+        self.lag_count = 0
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed + self.unknown
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time_module.monotonic()) - self.started_at
+
+    @property
+    def lag_avg(self) -> float:
+        return self.lag_total / self.lag_count if self.lag_count else 0.0
+
+    def add_lag(self, lag: float):
+        lag = max(0.0, lag)
+        self.lag_max = max(self.lag_max, lag)
+        self.lag_total += lag
+        self.lag_count += 1
+
+
+def spread_slot(user_id, window: int) -> int:
+    """Постоянный сдвиг пользователя внутри окна рассылки, секунды от начала окна."""
+    if window <= 0:
+        return 0
+    return zlib.crc32(str(user_id).encode()) % window
+
+
+async def send_with_retry(send, chat_id: int, limiter: BroadcastRateLimiter = BROADCAST_LIMITER):
+    """Одна отправка под общим лимитом: RetryAfter ждём и повторяем, сетевые ошибки — повторяем."""
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await limiter.wait(chat_id)
+        try:
+            return await send(chat_id)
+        except RetryAfter as e:
+            delay = _retry_after_seconds(e)
+            limiter.pause(delay)
+            print(f">>> broadcast: RetryAfter {delay:.0f} с (чат {chat_id})")
+            if attempt >= BROADCAST_MAX_RETRIES:
+                raise
+        except BadRequest:
+            raise  # наследник NetworkError, но повторять бессмысленно
+        except NetworkError:
+            # в том числе TimedOut
+            if attempt >= BROADCAST_MAX_RETRIES:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+
+async def run_broadcast(user_ids, send, on_result=None, stats: BroadcastStats | None = None,
+                        concurrency: int = BROADCAST_CONCURRENCY, due_at=None) -> BroadcastStats:
+    """Рассылка по user_ids: send(chat_id) — корутина отправки одному пользователю.
+
+    Отправляют concurrency воркеров, темп держит BROADCAST_LIMITER.
+    on_result(user_id, error) — вызывается после каждой попытки (error=None при успехе).
+    Если передан stats, итоги добавляются в него (рассылка по частям).
+    due_at(user_id) — unix-время, раньше которого пользователю не шлём
+    (user_ids тогда идут по возрастанию due_at); отставание копится в stats.
+    """
+    user_ids = list(user_ids)
+    is_part = stats is not None
+    if stats is None:
+        stats = BroadcastStats(len(user_ids))
+    queue: asyncio.Queue = asyncio.Queue()
+    for uid in user_ids:
+        queue.put_nowait(uid)
+
+    async def worker():
+        while True:
+            try:
+                uid = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            error = None
+            due = due_at(uid) if due_at is not None else None
+            if due is not None:
+                delay = due - time_module.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            try:
+                await send_with_retry(send, uid)
+                stats.sent += 1
+                if due is not None:
+                    stats.add_lag(time_module.time() - due)
+            except Exception as e:
+                error = e
+                stats.failed += 1
+                stats.failures.append((uid, f"{type(e).__name__} - {e}"))
+                print(f"❌ Ошибка при отправке пользователю {uid}: {e}")
+                if is_dead_chat_error(e):
+                    await run_store(BLOCKED_USERS.mark, uid, e)
+            if on_result is not None:
+                try:
+                    on_result(uid, error)
+                except Exception as e:
+                    print(f">>> broadcast on_result error: {e}")
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(user_ids))))))
+    if is_part:
+        return stats
+    stats.finished_at = time_module.monotonic()
+    print(f"📢 Рассылка завершена: {stats.sent}/{stats.total} за {stats.elapsed:.0f} с, ошибок {stats.failed}")
+    return stats
+
+
+def _collect_user_ids(user_list) -> list[int]:
+    """Уникальные корректные user_id из строк пользователей (порядок — по первому появлению)."""
+    unique_user_ids = {}
+    for user_data in user_list:
+        user_id_str = str(user_data.get("user_id", "")).strip()
+        if user_id_str:
+            try:
+                unique_user_ids[int(user_id_str)] = None
+            except ValueError:
+                print(f"⚠️ Неверный ID пользователя: '{user_id_str}', пропущен.")
+    return list(unique_user_ids)
+
+
+# --- НОВЫЙ ОБРАБОТЧИК ДЛЯ ЗАПРОСА РАССЫЛКИ (исправленный для HTML)---
+import html
+
+async def handle_broadcast_request(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
+    """Обрабатывает запрос на рассылку от администратора."""
+    query = update.callback_query
+    user = query.from_user
+    print(f"📤 Администратор {user.id} запрашивает рассылку: {message_text[:100]}...")
+
+    # Загрузка списка пользователей
+    users = await run_store(get_cached_users) # Используем кэшированную функцию, если доступна
+
+    if not users:
+        error_msg = "❌ Не удалось получить список пользователей для рассылки."
+        await query.edit_message_text(error_msg)
+        print(error_msg)
+        return
+
+    user_ids = BLOCKED_USERS.filter(_collect_user_ids(users))
+    recipients = len(user_ids)
+    campaign_id = f"admin:{user.id}:{int(time_module.time())}"
+    try:
+        created = await run_store(
+            CAMPAIGNS.create, campaign_id, "admin_text",
+            {"text": message_text, "admin_chat_id": query.message.chat_id,
+             "progress_message_id": query.message.message_id},
+            user_ids,
+        )
+    except Exception as e:
+        print(f">>> handle_broadcast_request: не удалось создать кампанию {campaign_id}: {e}")
+        await query.edit_message_text("❌ Не удалось запустить рассылку, попробуйте ещё раз.")
+        return
+    if not created:
+        # повторное нажатие в ту же секунду — рассылка с этим id уже идёт
+        print(f">>> handle_broadcast_request: кампания {campaign_id} уже существует")
+        await query.edit_message_text("⚠️ Эта рассылка уже запущена, повторно не отправляем.")
+        return
+    await query.edit_message_text(
+        text=f"<b>📤 РАССЫЛКА ЗАПУЩЕНА</b>\n\n<b>Сообщение:</b>\n{broadcast_preview_html(message_text)}\n\n"
+             f"Получателей: <b>{recipients}</b>. Прогресс и итоговый отчёт появятся в этом сообщении, "
+             f"остановить рассылку можно кнопкой под ним.",
+        parse_mode='HTML',
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("⛔ Остановить рассылку", callback_data=f"st:bc_cancel:{campaign_id}")]
+        ]),
+    )
+
+    # Сама рассылка идёт фоновой задачей — колбэк админа не ждёт её окончания;
+    # прогресс пишется в базу, после перезапуска рассылка продолжится
+    context.application.create_task(run_campaign(context.bot, campaign_id), update=update)
+
+
+def format_broadcast_report_html(stats: BroadcastStats) -> str:
+    """HTML-отчёт о рассылке."""
+    total_recipients = stats.total
+    success_count = stats.sent
+    failure_count = stats.failed
+
+    # Формируем HTML-отчет
+    import html
+    report_parts = []
+    report_parts.append(f"<b>📢 РЕЗУЛЬТАТЫ РАССЫЛКИ</b>")
+    report_parts.append(f"Всего пользователей для рассылки: <b>{total_recipients}</b>")
+    report_parts.append(f"✅ Успешно доставлено: <b>{success_count}</b>")
+    report_parts.append(f"❌ Не доставлено: <b>{failure_count}</b>")
+    if stats.unknown:
+        report_parts.append(f"❔ Прервано перезапуском: <b>{stats.unknown}</b>")
+    report_parts.append(f"⏱ Время: <b>{stats.elapsed:.0f} с</b>")
+    report_parts.append("---")
+
+    if failure_count:
+        # полный список — CSV-файлом (см. failures_csv), в сообщение он не влезет
+        report_parts.append("Список ошибок — в приложенном CSV.")
+
+    return "\n".join(report_parts)
+
+
+def failures_csv(stats: BroadcastStats) -> InputFile:
+    """Все ошибки рассылки CSV-файлом: user_id, username, first_name, error."""
+    profiles = USER_TIMELINE.profiles(str(uid) for uid, _ in stats.failures)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["user_id", "username", "first_name", "error"])
+    for uid, error in stats.failures:
+        info = profiles.get(str(uid), {})
+        writer.writerow([uid, info.get("username", ""), info.get("first_name", ""), error])
+    # utf-8-sig — чтобы Excel открыл кириллицу без танцев
+    return InputFile(io.BytesIO(buf.getvalue().encode("utf-8-sig")), filename="broadcast_errors.csv")
+
+# ===== рассылки как задания (переживают перезапуск) =====
+
+
+class BroadcastCampaigns:
+    """Рассылки хранятся в SQLite: кампания и статус каждого получателя.
+
+    Получатели берутся пачками по BROADCAST_CHECKPOINT_EVERY: пачка помечается
+    'sending', после отправки — 'sent' / 'failed'. Каждый (кампания, пользователь)
+    получает сообщение не более одного раза: если процесс убили посреди пачки,
+    при возобновлении её 'sending'-строки становятся 'unknown' и не повторяются.
+    В рассылке с окном у каждого получателя свой due_at, и в пачку попадают
+    только те, чей слот уже наступил — ждущие слота остаются 'pending'.
+    """
+
+    def __init__(self, store: EventStore):
+        self.store = store
+        self.active: set[str] = set()  # кампании, которые крутятся в этом процессе
+        self.cancel_requested: set[str] = set()
+        store.execute(
+            "CREATE TABLE IF NOT EXISTS broadcast_campaigns ("
+            "id TEXT PRIMARY KEY, kind TEXT NOT NULL, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL, created_at TEXT NOT NULL, finished_at TEXT NOT NULL DEFAULT '')"
+        )
+        store.execute(
+            "CREATE TABLE IF NOT EXISTS broadcast_recipients ("
+            "campaign_id TEXT NOT NULL, user_id INTEGER NOT NULL, position INTEGER NOT NULL, "
+            "status TEXT NOT NULL, error TEXT NOT NULL DEFAULT '', sent_at TEXT NOT NULL DEFAULT '', "
+            "due_at REAL NOT NULL DEFAULT 0, "
+            "PRIMARY KEY (campaign_id, user_id))"
+        )
+        columns = {r["name"] for r in store.query("PRAGMA table_info(broadcast_recipients)")}
+        if "due_at" not in columns:
+            store.execute("ALTER TABLE broadcast_recipients ADD COLUMN due_at REAL NOT NULL DEFAULT 0")
+        store.execute(
+            "CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status "
+            "ON broadcast_recipients(campaign_id, status, position)"
+        )
+
+    def create(self, campaign_id: str, kind: str, payload: dict, user_ids: list[int]) -> bool:
+        """Новая кампания; False, если кампания с таким id уже есть."""
+        if self.get(campaign_id) is not None:
+            return False
+        user_ids = BLOCKED_USERS.filter(user_ids)
+        if payload.get("window"):
+            # рассылка с окном: порядок получателей — по их слотам
+            user_ids = sorted(user_ids, key=lambda uid: spread_slot(uid, payload["window"]))
+        due_at = CAMPAIGN_KINDS[kind].due_at
+        # сначала получатели, потом сама кампания — без неё они не запустятся
+        self.store.execute_many(
+            "INSERT OR IGNORE INTO broadcast_recipients (campaign_id, user_id, position, status, due_at) "
+            "VALUES (?, ?, ?, 'pending', ?)",
+            [(campaign_id, uid, pos, due_at(payload, uid) or 0) for pos, uid in enumerate(user_ids)],
+        )
+        self.store.execute(
+            "INSERT INTO broadcast_campaigns (id, kind, payload, status, created_at) "
+            "VALUES (?, ?, ?, 'running', ?)",
+            (campaign_id, kind, json.dumps(payload, ensure_ascii=False),
+             datetime.now(UTC).isoformat(timespec="seconds")),
+        )
+        return True
+
+    def get(self, campaign_id: str) -> dict | None:
+        rows = self.store.query("SELECT * FROM broadcast_campaigns WHERE id = ?", (campaign_id,))
+        if not rows:
+            return None
+        campaign = rows[0]
+        campaign["payload"] = json.loads(campaign["payload"])
+        return campaign
+
+    def running(self) -> list[str]:
+        rows = self.store.query("SELECT id FROM broadcast_campaigns WHERE status = 'running' ORDER BY created_at")
+        return [r["id"] for r in rows]
+
+    def recover(self, campaign_id: str) -> int:
+        """Пачка, прерванная перезапуском: судьба этих отправок неизвестна, повторно не шлём."""
+        return self.store.execute(
+            "UPDATE broadcast_recipients SET status = 'unknown' WHERE campaign_id = ? AND status = 'sending'",
+            (campaign_id,),
+        )
+
+    def claim(self, campaign_id: str, limit: int) -> list[int]:
+        """До limit получателей, чей слот уже наступил, — помечаем их 'sending'."""
+        rows = self.store.query(
+            "SELECT user_id FROM broadcast_recipients WHERE campaign_id = ? AND status = 'pending' "
+            "AND due_at <= ? ORDER BY position LIMIT ?",
+            (campaign_id, time_module.time(), limit),
+        )
+        user_ids = [r["user_id"] for r in rows]
+        self.store.execute_many(
+            "UPDATE broadcast_recipients SET status = 'sending' WHERE campaign_id = ? AND user_id = ?",
+            [(campaign_id, uid) for uid in user_ids],
+        )
+        return user_ids
+
+    def next_due(self, campaign_id: str) -> float | None:
+        """Ближайший слот среди ещё не отправленных (None — отправлять больше некому)."""
+        rows = self.store.query(
+            "SELECT MIN(due_at) AS due FROM broadcast_recipients WHERE campaign_id = ? AND status = 'pending'",
+            (campaign_id,),
+        )
+        return rows[0]["due"] if rows else None
+
+    def checkpoint(self, campaign_id: str, results: list[tuple[int, Exception | None]]):
+        now_iso = datetime.now(UTC).isoformat(timespec="seconds")
+        self.store.execute_many(
+            "UPDATE broadcast_recipients SET status = ?, error = ?, sent_at = ? "
+            "WHERE campaign_id = ? AND user_id = ?",
+            [
+                ("sent" if err is None else "failed",
+                 "" if err is None else f"{type(err).__name__} - {err}",
+                 now_iso, campaign_id, uid)
+                for uid, err in results
+            ],
+        )
+
+    def cancel(self, campaign_id: str) -> bool:
+        """Остановить кампанию после текущей пачки; неотправленные остаются 'pending'."""
+        campaign = self.get(campaign_id)
+        if campaign is None or campaign["status"] != "running":
+            return False
+        if campaign_id in self.active:
+            self.cancel_requested.add(campaign_id)
+        else:
+            self.finish(campaign_id, "cancelled")
+        return True
+
+    def finish(self, campaign_id: str, status: str = "done"):
+        self.store.execute(
+            "UPDATE broadcast_campaigns SET status = ?, finished_at = ? WHERE id = ?",
+            (status, datetime.now(UTC).isoformat(timespec="seconds"), campaign_id),
+        )
+
+    def stats(self, campaign_id: str) -> BroadcastStats:
+        """Итоги кампании по базе (с учётом отправок до перезапуска)."""
+        counts = {
+            r["status"]: r["n"]
+            for r in self.store.query(
+                "SELECT status, COUNT(*) AS n FROM broadcast_recipients WHERE campaign_id = ? GROUP BY status",
+                (campaign_id,),
+            )
+        }
+        stats = BroadcastStats(sum(counts.values()))
+        stats.sent = counts.get("sent", 0)
+        stats.failed = counts.get("failed", 0)
+        stats.unknown = counts.get("unknown", 0)
+        stats.failures = [
+            (r["user_id"], r["error"])
+            for r in self.store.query(
+                "SELECT user_id, error FROM broadcast_recipients WHERE campaign_id = ? AND status = 'failed' "
+                "ORDER BY position",
+                (campaign_id,),
+            )
+        ]
+        campaign = self.get(campaign_id)
+        created = parse_iso(campaign["created_at"]) if campaign else None
+        if created is not None:
+            stats.started_at = time_module.monotonic() - (datetime.now(UTC) - created).total_seconds()
+        return stats
 
-    Args:
-        bot: Экземпляр бота telegram.ext.Application.
-        user_list (list): Список словарей пользователей (например, из load_users).
-                           Должен содержать ключ 'user_id'.
-        message_text (str): Текст сообщения для рассылки.
 
-    Returns:
-        str: Отформатированный отчет о результатах рассылки.
+CAMPAIGNS = BroadcastCampaigns(STORE)
+
+
+class CampaignKind:
+    """Вид рассылки: как отправить одному пользователю и что сделать с результатами.
+
+    Если в payload есть window и start, получатели распределяются по окну:
+    каждому — постоянный слот spread_slot(user_id, window) от start.
     """
-    success_count = 0
-    failure_count = 0
-    failure_details = []
 
-    unique_user_ids = set()
-    for user_data in user_list:
-        user_id_str = user_data.get("user_id", "").strip()
-        if user_id_str:
-            try:
-                user_id_int = int(user_id_str)
-                unique_user_ids.add(user_id_int)
-            except ValueError:
-                print(f"⚠️ Неверный ID пользователя: '{user_id_str}', пропущен.")
+    progress_interval = BROADCAST_PROGRESS_INTERVAL
 
-    total_recipients = len(unique_user_ids)
+    async def send(self, bot, payload: dict, chat_id: int):
+        return await bot.send_message(chat_id=chat_id, text=payload["text"])
 
-    if total_recipients == 0:
-        return "❌ Не найдено корректных ID пользователей для рассылки."
+    def due_at(self, payload: dict, user_id) -> float | None:
+        if not payload.get("window"):
+            return None
+        return payload["start"] + spread_slot(user_id, payload["window"])
 
-    print(f"📢 Начинаю рассылку {message_text[:50]}... (всего {total_recipients} уникальных пользователей)")
+    def on_checkpoint(self, payload: dict, sent_ids: list[int]):
+        """Вызывается в пуле потоков после каждой пачки."""
 
-    for user_id in unique_user_ids:
-        try:
-            await bot.send_message(chat_id=user_id, text=message_text)
-            success_count += 1
-            print(f"✅ Сообщение успешно отправлено пользователю {user_id}")
-        except Exception as e:
-            failure_count += 1
-            error_detail = f"user_id: {user_id}, error: {type(e).__name__} - {str(e)}"
-            failure_details.append(error_detail)
-            print(f"❌ Ошибка при отправке пользователю {user_id}: {e}")
-
-    report_lines = []
-    report_lines.append(f"📢 *РЕЗУЛЬТАТЫ РАССЫЛКИ*")
-    report_lines.append(f"Всего пользователей для рассылки: *{total_recipients}*")
-    report_lines.append(f"✅ Успешно доставлено: *{success_count}*")
-    report_lines.append(f"❌ Не доставлено: *{failure_count}*")
-    report_lines.append("---")
-
-    if failure_details:
-        report_lines.append("*Детали ошибок:*")
-        for detail in failure_details:
-            # Экранируем символы Markdown в деталях ошибки, так как они могут содержать _
-            escaped_detail = esc_md2(detail)
-            report_lines.append(f"`{escaped_detail}`")
-        report_lines.append("---")
-
-    return "\n".join(report_lines)
+    async def on_progress(self, bot, campaign_id: str, payload: dict, stats: BroadcastStats, eta: float | None):
+        """Вызывается не чаще раза в BROADCAST_PROGRESS_INTERVAL секунд."""
 
-# --- НОВЫЙ ОБРАБОТЧИК ДЛЯ ЗАПРОСА РАССЫЛКИ (исправленный для HTML)---
-import html
+    async def on_finish(self, bot, payload: dict, stats: BroadcastStats, cancelled: bool = False):
+        pass
 
-async def handle_broadcast_request(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str):
-    """Обрабатывает запрос на рассылку от администратора."""
-    query = update.callback_query
-    user = query.from_user
-    print(f"📤 Администратор {user.id} запрашивает рассылку: {message_text[:100]}...")
 
-    # Загрузка списка пользователей
-    users = get_cached_users() # Используем кэшированную функцию, если доступна
+BROADCAST_PREVIEW_CHARS = 500
 
-    if not users:
-        error_msg = "❌ Не удалось получить список пользователей для рассылки."
-        await query.edit_message_text(error_msg)
-        print(error_msg)
-        return
 
-    # Вызов функции рассылки
-    report = await broadcast_message_to_users_html(context.bot, users, message_text) # Вызываем новую версию
+def broadcast_preview_html(text: str) -> str:
+    """Начало текста рассылки для сообщений админу: полный текст вместе с отчётом
+    может не влезть в лимит Telegram (4096 символов)."""
+    if len(text) > BROADCAST_PREVIEW_CHARS:
+        text = text[:BROADCAST_PREVIEW_CHARS].rstrip() + "…"
+    return f"<pre>{html.escape(text)}</pre>"
 
-    # Отправка отчета администратору
-    escaped_message_text = html.escape(message_text) # Экранируем текст рассылки
-    report_html = f"<b>📤 ЗАПРОС НА РАССЫЛКУ ОТПРАВЛЕН</b>\n\n<b>Сообщение:</b>\n<pre>{escaped_message_text}</pre>\n\n---\n\n{report}"
-    try:
-        # Попробуем отредактировать сообщение с запросом
-        await query.edit_message_text(
-            text=report_html,
-            parse_mode='HTML'
+
+class AdminTextCampaign(CampaignKind):
+    """Рассылка из админ-меню: прогресс — в сообщении админа (с кнопкой остановки),
+    итоговый отчёт — туда же, ошибки — CSV-файлом.
+    """
+
+    async def on_progress(self, bot, campaign_id: str, payload: dict, stats: BroadcastStats, eta: float | None):
+        if eta is None:
+            eta_str = "—"
+        elif eta < 90:
+            eta_str = f"~{eta:.0f} с"
+        else:
+            eta_str = f"~{eta / 60:.0f} мин"
+        text = (
+            "<b>📤 РАССЫЛКА ИДЁТ</b>\n\n"
+            f"✅ Отправлено: <b>{stats.sent}</b>\n"
+            f"❌ Ошибок: <b>{stats.failed}</b>\n"
+            f"⏳ Осталось: <b>{stats.total - stats.done}</b> (ещё {eta_str})"
         )
-    except Exception:
-        # Если невозможно отредактировать (например, слишком длинное), отправим новое
-        await query.message.reply_text(
-            text=report_html,
-            parse_mode='HTML'
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("⛔ Остановить рассылку", callback_data=f"st:bc_cancel:{campaign_id}")]
+        ])
+        await self._edit(bot, payload, text, keyboard)
+
+    async def on_finish(self, bot, payload: dict, stats: BroadcastStats, cancelled: bool = False):
+        title = "⛔ РАССЫЛКА ОСТАНОВЛЕНА" if cancelled else "📤 РАССЫЛКА ЗАВЕРШЕНА"
+        report_html = (
+            f"<b>{title}</b>\n\n<b>Сообщение:</b>\n{broadcast_preview_html(payload['text'])}"
+            f"\n\n---\n\n{format_broadcast_report_html(stats)}"
         )
+        if cancelled:
+            report_html += f"\nНе отправлено (остановлено): <b>{stats.total - stats.done}</b>"
+        if not await self._edit(bot, payload, report_html, None):
+            try:
+                await bot.send_message(chat_id=payload["admin_chat_id"], text=report_html, parse_mode='HTML')
+            except Exception as e:
+                print(f"📤 Не удалось отправить отчёт о рассылке администратору: {e}")
+        if stats.failures:
+            try:
+                await bot.send_document(
+                    chat_id=payload["admin_chat_id"],
+                    document=await run_store(failures_csv, stats),
+                    caption=f"Ошибки рассылки: {len(stats.failures)}",
+                )
+            except Exception as e:
+                print(f"📤 Не удалось отправить CSV с ошибками рассылки: {e}")
+        print(f"📤 Рассылка завершена. Отчет отправлен в чат {payload['admin_chat_id']}.")
 
-    print(f"📤 Рассылка завершена. Отчет отправлен администратору {user.id}.")
+    async def _edit(self, bot, payload: dict, text: str, keyboard) -> bool:
+        message_id = payload.get("progress_message_id")
+        if not message_id:
+            return False
+        try:
+            await bot.edit_message_text(
+                chat_id=payload["admin_chat_id"], message_id=message_id,
+                text=text, parse_mode='HTML', reply_markup=keyboard,
+            )
+            return True
+        except BadRequest as e:
+            # "message is not modified" — прогресс не изменился, это не ошибка
+            return "not modified" in str(e).lower()
+        except Exception as e:
+            print(f">>> broadcast progress edit error: {e}")
+            return False
 
-# --- НОВАЯ ВЕРСИЯ broadcast_message_to_users для генерации HTML отчета ---
-async def broadcast_message_to_users_html(bot, user_list, message_text):
-    """
-    Выполняет рассылку сообщения указанному списку пользователей.
 
-    Args:
-        bot: Экземпляр бота telegram.ext.Application.
-        user_list (list): Список словарей пользователей (например, из load_users).
-                           Должен содержать ключ 'user_id'.
-        message_text (str): Текст сообщения для рассылки.
+def text_version(text: str) -> str:
+    """Короткий id версии текста рассылки: одинаковый текст — одинаковый id."""
+    return "v" + hashlib.sha1(text.encode("utf-8")).hexdigest()[:8]
 
-    Returns:
-        str: Отформатированный HTML отчет о результатах рассылки.
-    """
-    success_count = 0
-    failure_count = 0
-    failure_details = []
 
-    unique_user_ids = set()
-    for user_data in user_list:
-        user_id_str = user_data.get("user_id", "").strip()
-        if user_id_str:
-            try:
-                user_id_int = int(user_id_str)
-                unique_user_ids.add(user_id_int)
-            except ValueError:
-                print(f"⚠️ Неверный ID пользователя: '{user_id_str}', пропущен.")
+def record_text_version(version: str, text: str):
+    """Запоминаем текст версии в auto_nurture_texts (один раз на версию), вкладку догонит репликатор."""
+    if STORE.query(f"SELECT 1 FROM {AUTO_NURTURE_TEXTS_SHEET_NAME} WHERE version = ? LIMIT 1", (version,)):
+        return
+    store_rows(AUTO_NURTURE_TEXTS_SHEET_NAME, [[version, text, datetime.now(UTC).isoformat(timespec="seconds")]])
 
-    total_recipients = len(unique_user_ids)
 
-    if total_recipients == 0:
-        return "❌ Не найдено корректных ID пользователей для рассылки."
+class AutoNurtureCampaign(CampaignKind):
+    """Авторассылка: после каждой пачки пишем историю отправок в таблицу auto_nurture."""
 
-    print(f"📢 Начинаю рассылку {message_text[:50]}... (всего {total_recipients} уникальных пользователей)")
+    def on_checkpoint(self, payload: dict, sent_ids: list[int]):
+        if not sent_ids:
+            return
+        profiles = USER_TIMELINE.profiles(str(uid) for uid in sent_ids)
+        rows = []
+        for uid in sent_ids:
+            info = profiles.get(str(uid), {})
+            rows.append([
+                str(uid),                     # A - user_id
+                info.get("username", ""),     # B - username
+                info.get("first_name", ""),   # C - first_name
+                "auto_nurture",               # D - action (тип рассылки)
+                payload["date"],              # E - sent_date
+                "sent",                       # F - status
+                "",                           # G - error_msg (пусто при успехе)
+                payload["text_version"],      # H - версия текста (текст — во вкладке auto_nurture_texts)
+                str(payload["period"]),       # I - period (для истории)
+            ])
+        # В базу; во вкладку 'auto_nurture' строки допишет репликатор
+        store_rows(AUTO_NURTURE_SHEET_NAME, rows)
+
+    async def on_finish(self, bot, payload: dict, stats: BroadcastStats, cancelled: bool = False):
+        print(f"🏁 Автоматическая воронка завершена. Успешно: {stats.sent}, Ошибки: {stats.failed}, "
+              f"отставание от расписания макс {stats.lag_max:.0f} с")
+
+
+class SpreadCampaign(CampaignKind):
+    """Массовая джоба с окном доставки: в лог — темп и отставание от расписания."""
+
+    progress_interval = 60.0
+
+    async def on_progress(self, bot, campaign_id: str, payload: dict, stats: BroadcastStats, eta: float | None):
+        window_left = payload["start"] + payload.get("window", 0) - time_module.time()
+        print(f">>> {campaign_id}: {stats.done}/{stats.total}, "
+              f"отставание макс {stats.lag_max:.0f} с / сред {stats.lag_avg:.1f} с, "
+              f"до конца окна {max(window_left, 0) / 60:.0f} мин")
+
+    async def on_finish(self, bot, payload: dict, stats: BroadcastStats, cancelled: bool = False):
+        rate = stats.sent / stats.elapsed if stats.elapsed > 0 else 0.0
+        print(f"🏁 {payload.get('name', 'рассылка')}: отправлено {stats.sent}/{stats.total} "
+              f"({rate:.2f} сообщ/с), ошибок {stats.failed}, "
+              f"отставание от расписания макс {stats.lag_max:.0f} с, сред {stats.lag_avg:.1f} с")
+
+
+CAMPAIGN_KINDS: dict[str, CampaignKind] = {
+    "admin_text": AdminTextCampaign(),
+    "auto_nurture": AutoNurtureCampaign(),
+    "daily_reminder": SpreadCampaign(),
+}
 
-    for user_id in unique_user_ids:
-        try:
-            await bot.send_message(chat_id=user_id, text=message_text)
-            success_count += 1
-            print(f"✅ Сообщение успешно отправлено пользователю {user_id}")
-        except Exception as e:
-            failure_count += 1
-            error_detail = f"user_id: {user_id}, error: {type(e).__name__} - {str(e)}"
-            failure_details.append(error_detail)
-            print(f"❌ Ошибка при отправке пользователю {user_id}: {e}")
 
-    # Формируем HTML-отчет
-    import html
-    report_parts = []
-    report_parts.append(f"<b>📢 РЕЗУЛЬТАТЫ РАССЫЛКИ</b>")
-    report_parts.append(f"Всего пользователей для рассылки: <b>{total_recipients}</b>")
-    report_parts.append(f"✅ Успешно доставлено: <b>{success_count}</b>")
-    report_parts.append(f"❌ Не доставлено: <b>{failure_count}</b>")
-    report_parts.append("---")
+CAMPAIGN_WAIT_STEP = 1.0  # сек между проверками отмены, пока ждём слотов окна
 
-    if failure_details:
-        report_parts.append("<b>Детали ошибок:</b>")
-        for detail in failure_details:
-            # Экранируем детали ошибки для HTML
-            escaped_detail = html.escape(detail)
-            report_parts.append(f"<pre>{escaped_detail}</pre>")
-        report_parts.append("---")
 
-    return "\n".join(report_parts)
+async def run_campaign(bot, campaign_id: str):
+    """Досылаем кампанию до конца, сохраняя прогресс после каждой пачки."""
+    if campaign_id in CAMPAIGNS.active:
+        return
+    CAMPAIGNS.active.add(campaign_id)
+    try:
+        campaign = await run_store(CAMPAIGNS.get, campaign_id)
+        if campaign is None or campaign["status"] != "running":
+            return
+        kind = CAMPAIGN_KINDS[campaign["kind"]]
+        payload = campaign["payload"]
+
+        async def send(chat_id):
+            return await kind.send(bot, payload, chat_id)
+
+        # live — итоги с учётом отправок до перезапуска, дополняются по ходу
+        live = await run_store(CAMPAIGNS.stats, campaign_id)
+        run_started, done_at_start = time_module.monotonic(), live.done
+        last_progress = 0.0
+        cancelled = False
+
+        while True:
+            if campaign_id in CAMPAIGNS.cancel_requested:
+                cancelled = True
+                break
+            chunk = await run_store(CAMPAIGNS.claim, campaign_id, BROADCAST_CHECKPOINT_EVERY)
+            if not chunk:
+                next_due = await run_store(CAMPAIGNS.next_due, campaign_id)
+                if next_due is None:
+                    break
+                # ждём слота следующего получателя короткими шагами, чтобы отмена срабатывала сразу
+                await asyncio.sleep(min(max(next_due - time_module.time(), 0.0), CAMPAIGN_WAIT_STEP))
+                continue
+            # кто заблокировал бота уже после создания кампании — не шлём
+            alive = BLOCKED_USERS.filter(chunk)
+            alive_set = set(alive)
+            results = [(uid, Forbidden("blocked earlier")) for uid in chunk if uid not in alive_set]
+            live.failed += len(results)
+            await run_broadcast(
+                alive, send,
+                on_result=lambda uid, err: results.append((uid, err)),
+                stats=live,
+                due_at=lambda uid: kind.due_at(payload, uid),
+            )
+            await run_store(CAMPAIGNS.checkpoint, campaign_id, results)
+            try:
+                await run_store(kind.on_checkpoint, payload, [uid for uid, err in results if err is None])
+            except Exception as e:
+                print(f">>> campaign {campaign_id}: ошибка on_checkpoint: {e}")
+
+            now = time_module.monotonic()
+            if now - last_progress >= kind.progress_interval:
+                last_progress = now
+                rate = (live.done - done_at_start) / max(now - run_started, 0.001)
+                eta = (live.total - live.done) / rate if rate > 0 else None
+                await kind.on_progress(bot, campaign_id, payload, live, eta)
+
+        await run_store(CAMPAIGNS.finish, campaign_id, "cancelled" if cancelled else "done")
+        stats = await run_store(CAMPAIGNS.stats, campaign_id)
+        stats.finished_at = time_module.monotonic()
+        stats.lag_max, stats.lag_total, stats.lag_count = live.lag_max, live.lag_total, live.lag_count
+        print(f"📢 Кампания {campaign_id}: {stats.sent}/{stats.total} за {stats.elapsed:.0f} с, "
+              f"ошибок {stats.failed}, прервано {stats.unknown}" + (" — остановлена" if cancelled else ""))
+        await kind.on_finish(bot, payload, stats, cancelled)
+    finally:
+        CAMPAIGNS.active.discard(campaign_id)
+        CAMPAIGNS.cancel_requested.discard(campaign_id)
+
+
+async def resume_campaigns_job(context: ContextTypes.DEFAULT_TYPE):
+    """После старта досылаем кампании, прерванные перезапуском."""
+    for campaign_id in await run_store(CAMPAIGNS.running):
+        if campaign_id in CAMPAIGNS.active:
+            continue
+        interrupted = await run_store(CAMPAIGNS.recover, campaign_id)
+        print(f">>> Возобновляю рассылку {campaign_id} (прервано посреди отправки: {interrupted})")
+        context.application.create_task(run_campaign(context.bot, campaign_id))
 
 # --- ОБНОВЛЁННАЯ ФУНКЦИЯ ДЛЯ АВТОМАТИЧЕСКОЙ РАССЫЛКИ С ИСПОЛЬЗОВАНИЕМ ОТДЕЛЬНОЙ ВКЛАДКИ ---
 import asyncio
@@ -816,6 +2966,7 @@ async def auto_nurture_broadcast(context: ContextTypes.DEFAULT_TYPE):
     Использует глобальную переменную GS_AUTO_NURTURE_WS.
     """
     print("🔄 Запуск автоматической воронки из вкладки 'auto_nurture'...")
+    GS_PRIORITY.set(GS_BACKGROUND)
     bot = context.bot
 
     # Проверяем, инициализирована ли глобальная переменная GS_AUTO_NURTURE_WS
@@ -832,7 +2983,7 @@ async def auto_nurture_broadcast(context: ContextTypes.DEFAULT_TYPE):
 
     # 1. Чтение настроек из строки 1
     try:
-        settings_row = worksheet.row_values(1) # Получаем первую строку
+        settings_row = await run_gs(worksheet.row_values, 1) # Получаем первую строку
         if len(settings_row) < 8: # Проверяем, достаточно ли колонок (user_id, username, first_name, action, sent_date, status, error_msg, text, period)
             print("❌ Недостаточно данных в строке 1 вкладки 'auto_nurture'. Ожидаемые колонки: user_id, username, first_name, action, sent_date, status, error_msg, text, period")
             return
@@ -862,59 +3013,30 @@ async def auto_nurture_broadcast(context: ContextTypes.DEFAULT_TYPE):
 
     print(f"📋 Найдены настройки: период = {stored_period_days} дней, текст = '{stored_text[:30]}...'")
 
-    # 2. Загрузка истории отправок (все строки, кроме первой)
+    # 2. Индекс «пользователь → дата последней отправки» (ведётся в базе при записи истории)
     try:
-        all_rows = worksheet.get_all_values()
-        if len(all_rows) <= 1:
-            history_rows = [] # Нет истории, только настройки
-        else:
-            history_rows = all_rows[1:] # Берём все строки, кроме первой (настройки)
+        last_sent_date_per_user_id = await run_store(STORE.auto_nurture_last_sent)
     except Exception as e:
-        print(f"❌ Ошибка загрузки истории из вкладки 'auto_nurture': {e}")
+        print(f"❌ Ошибка загрузки истории авторассылки из базы: {e}")
         return
 
-    # 3. Формирование словаря last_sent_date_per_user_id
-    last_sent_date_per_user_id = {}
-    for row in history_rows:
-        if len(row) > 4: # Проверяем, что есть user_id и sent_date
-            user_id_str = row[0].strip() # Колонка A
-            sent_date_str = row[4].strip() # Колонка E (sent_date)
-            if user_id_str and sent_date_str:
-                try:
-                    # Предполагаем формат YYYY-MM-DD
-                    sent_date_obj = datetime.strptime(sent_date_str, "%Y-%m-%d").date()
-                    # Если для одного user_id есть несколько записей, берём самую последнюю
-                    existing_date = last_sent_date_per_user_id.get(user_id_str)
-                    if existing_date is None or sent_date_obj > existing_date:
-                        last_sent_date_per_user_id[user_id_str] = sent_date_obj
-                except ValueError:
-                    print(f"⚠️ Неверный формат даты в истории для user_id {user_id_str}: '{sent_date_str}'")
-
-    # 4. Загрузка *всех* пользователей из основной вкладки (предположим, это USERS_SHEET_NAME, к которому у нас есть доступ через GS_USERS_WS, но проще использовать get_cached_users/load_users)
-    # Используем вашу существующую функцию для получения пользователей
-    users = get_cached_users() # или load_users(), если у вас нет кэша
+    # 3. Профили всех пользователей (user_id -> username / first_name / ...)
+    profiles = await run_store(USER_TIMELINE.snapshot)
 
-    if not users:
-        print("❌ Не удалось получить список пользователей для автоматической воронки из основной вкладки.")
+    if not profiles:
+        print("❌ Не удалось получить список пользователей для автоматической воронки.")
         return
 
-    # 5. Определение даты "N дней назад"
-    cutoff_date = (datetime.now(UTC).date()) - timedelta(days=stored_period_days)
+    # 4. Определение даты "N дней назад" — даты YYYY-MM-DD сравниваем как строки
+    cutoff_date = ((datetime.now(UTC).date()) - timedelta(days=stored_period_days)).isoformat()
     print(f"📅 Пороговая дата (до которой НЕ отправляем): {cutoff_date}")
 
-    # 6. Фильтрация и отправка
-    users_to_notify = []
-    for user_data in users:
-        user_id_str = user_data.get("user_id", "").strip()
-        if not user_id_str:
-            continue
-
-        last_sent_date = last_sent_date_per_user_id.get(user_id_str)
-        # Отправляем, если:
-        # a) Пользователь никогда не получал это сообщение (last_sent_date is None)
-        # b) Последнее получение было раньше cutoff_date (т.е. прошло >= stored_period_days дней)
-        if last_sent_date is None or last_sent_date <= cutoff_date:
-            users_to_notify.append(user_id_str)
+    # 5. Фильтрация: отправляем, если пользователь ещё не получал рассылку
+    # или последнее получение было не позже cutoff_date (прошло >= stored_period_days дней)
+    users_to_notify = [
+        user_id_str for user_id_str in profiles
+        if last_sent_date_per_user_id.get(user_id_str, "") <= cutoff_date
+    ]
 
     total_to_notify = len(users_to_notify)
     print(f"📢 Найдено {total_to_notify} пользователей для отправки.")
@@ -922,53 +3044,24 @@ async def auto_nurture_broadcast(context: ContextTypes.DEFAULT_TYPE):
     if total_to_notify == 0:
         return
 
-    success_count = 0
-    failure_count = 0
-    successful_notifications = []
-
-    for user_id_str in users_to_notify:
-        try:
-            await bot.send_message(chat_id=int(user_id_str), text=stored_text)
-            success_count += 1
-            print(f"✅ Авто-воронка ({stored_period_days} дней) успешно отправлена пользователю {user_id_str}")
-            successful_notifications.append(user_id_str)
-        except Exception as e:
-            failure_count += 1
-            error_type = type(e).__name__
-            print(f"❌ Ошибка при отправке авто-воронки пользователю {user_id_str}: {error_type} - {e}")
-            # Здесь можно логировать ошибку в отдельную колонку, если нужно
-
-    # 7. Запись результатов в вкладку 'auto_nurture'
-    if successful_notifications:
-        try:
-            current_date_str = datetime.now(UTC).strftime("%Y-%m-%d")
-            rows_to_append = []
-            for user_id_str in successful_notifications:
-                # Попробуем получить username и first_name из основного списка
-                user_info = next((u for u in users if u.get("user_id") == user_id_str), {})
-                username = user_info.get("username", "")
-                first_name = user_info.get("first_name", "")
-
-                new_row = [
-                    user_id_str,  # A - user_id
-                    username,     # B - username
-                    first_name,   # C - first_name
-                    "auto_nurture", # D - action (тип рассылки)
-                    current_date_str, # E - sent_date
-                    "sent",       # F - status
-                    "",           # G - error_msg (пусто при успехе)
-                    stored_text,  # H - text (для истории, можно сократить)
-                    str(stored_period_days) # I - period (для истории)
-                ]
-                rows_to_append.append(new_row)
-
-            if rows_to_append:
-                worksheet.append_rows(rows_to_append) # Добавляем строки в конец
-                print(f"✅ Записано {len(rows_to_append)} строк об отправке в вкладку 'auto_nurture'.")
-        except Exception as write_e:
-            print(f"❌ Ошибка записи результата в Google Sheets: {write_e}")
-
-    print(f"🏁 Автоматическая воронка завершена. Успешно: {success_count}, Ошибки: {failure_count}")
+    # 6. Отправка — кампанией на сегодня: прогресс и историю (таблица auto_nurture)
+    # пишем после каждой пачки, повторный запуск в тот же день не шлёт второй раз.
+    # В историю вместо полного текста идёт его версия (хэш), сам текст — в auto_nurture_texts.
+    current_date_str = datetime.now(UTC).strftime("%Y-%m-%d")
+    campaign_id = f"auto_nurture:{current_date_str}"
+    version = text_version(stored_text)
+    await run_store(record_text_version, version, stored_text)
+    print(f"📝 Версия текста авторассылки {version}: '{stored_text[:60]}...'")
+    created = await run_store(
+        CAMPAIGNS.create, campaign_id, "auto_nurture",
+        {"text": stored_text, "text_version": version, "period": stored_period_days,
+         "date": current_date_str, "window": AUTO_NURTURE_WINDOW, "start": time_module.time()},
+        _collect_user_ids({"user_id": uid} for uid in users_to_notify),
+    )
+    if not created:
+        print(f"ℹ️ Кампания {campaign_id} уже создана — досылается она, новая не нужна.")
+        return
+    await run_campaign(bot, campaign_id)
 
 
 async def send_card_of_the_day_to_channel(context: ContextTypes.DEFAULT_TYPE):
@@ -978,7 +3071,7 @@ async def send_card_of_the_day_to_channel(context: ContextTypes.DEFAULT_TYPE):
         print(">>> Карта дня отключена (ручной режим)")
         return
     
-    card_data = load_card_of_the_day()
+    card_data = await run_gs(load_card_of_the_day)
     if card_data is None:
         print(">>> send_card_of_the_day_to_channel: нет данных")
         return
@@ -1011,22 +3104,22 @@ async def send_card_of_the_day_to_channel(context: ContextTypes.DEFAULT_TYPE):
         print(">>> send_card_of_the_day_to_channel: неполные данные в Sheets")
         return
     
-    image_path = os.path.join(CARD_OF_DAY_DIR, file_name)
-    if not os.path.exists(image_path):
-        print(f">>> send_card_of_the_day_to_channel: файл не найден {image_path}")
+    image = ASSETS.get(CARD_OF_DAY_DIR, file_name)
+    if image is None:
+        print(f">>> send_card_of_the_day_to_channel: файл не найден {os.path.join(CARD_OF_DAY_DIR, file_name)}")
         return
+    image_path = image["path"]
     
     try:
-        with open(image_path, "rb") as f:
-            await context.bot.send_photo(
-                chat_id=CHANNEL_USERNAME,
-                photo=f,
-                caption=text,
-                parse_mode=ParseMode.HTML,
-            )
+        await send_cached_photo(
+            functools.partial(context.bot.send_photo, chat_id=CHANNEL_USERNAME),
+            image_path,
+            caption=text,
+            parse_mode=ParseMode.HTML,
+        )
         print(f">>> Карта дня опубликована: {card_title}")
         # Логируем публикацию
-        log_card_of_day_publish(card_title, "auto")
+        store_later(log_card_of_day_publish, card_title, "auto")
     except Exception as e:
         print(f">>> send_card_of_the_day_to_channel error: {e}")
 
@@ -1062,7 +3155,7 @@ async def reload_packs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("⏳ Перезагружаю...")
     
-    load_packs_from_sheets()
+    await run_gs(load_packs_from_sheets)
     count = len(PACKS_DATA)
     result = f"✅ Загружено **{count}** раскладов!" if count else "❌ Ошибка!"
     
@@ -1071,16 +3164,76 @@ async def reload_packs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(result)
 
-def update_nurture_subscribed_after():
-    """Проставляем subscribed_after в nurture по актуальному статусу подписки из users."""
-    if GS_NURTURE_WS is None or GS_USERS_WS is None:
+async def warm_media_job(context: ContextTypes.DEFAULT_TYPE):
+    await warm_media_cache(context.bot, MEDIA_WARMUP_CHAT_ID)
+
+
+def _warm_media_text(result: dict, done: bool) -> str:
+    head = "✅ Прогрев картинок завершён" if done else "⏳ Прогрев картинок"
+    processed = result["cached"] + result["uploaded"] + result["failed"]
+    return (
+        f"{head}: {processed}/{result['total']}\n"
+        f"Уже были в кэше: {result['cached']}\n"
+        f"Загружено: {result['uploaded']}\n"
+        f"Ошибок: {result['failed']}"
+    )
+
+
+async def _warm_media_and_report(bot, chat_id: int, message):
+    last_edit = 0.0
+
+    async def on_progress(result: dict):
+        nonlocal last_edit
+        if time_module.monotonic() - last_edit < BROADCAST_PROGRESS_INTERVAL:
+            return
+        last_edit = time_module.monotonic()
+        try:
+            await message.edit_text(_warm_media_text(result, done=False))
+        except Exception:
+            pass
+
+    try:
+        result = await warm_media_cache(bot, chat_id, on_progress)
+        await message.edit_text(_warm_media_text(result, done=True))
+    except Exception as e:
+        print(f">>> warm_media error: {e}")
+        await message.edit_text(f"❌ Прогрев картинок прервался: {e}")
+
+
+async def warm_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Админ-команда /warm_media: загрузить все картинки и запомнить их file_id."""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS:
+        await update.message.reply_text("Эта команда только для администратора.")
         return
 
-    users = load_users()
-    if not users:
+    chat_id = MEDIA_WARMUP_CHAT_ID or update.effective_chat.id
+    message = await update.message.reply_text("⏳ Прогрев картинок: начинаю...")
+    # загрузка занимает минуту-другую — не держим обработку остальных апдейтов
+    context.application.create_task(_warm_media_and_report(context.bot, chat_id, message), update=update)
+
+
+def update_nurture_subscribed_after():
+    """Проставляем subscribed_after в nurture по актуальному статусу подписки из users.
+
+    В локальной базе — двумя UPDATE. В листе nurture считаем новую версию
+    столбца целиком и пишем один диапазон от первой до последней изменённой строки.
+    """
+    sub_map = STORE.user_status_map()
+    if not sub_map:
         return
 
-    sub_map = {row["user_id"]: row.get("subscribed", "unsub") for row in users}
+    try:
+        STORE.execute_many(
+            "UPDATE nurture SET subscribed_after = ? WHERE user_id = ? AND subscribed_after = ''",
+            [("yes" if status == "sub" else "no", uid) for uid, status in sub_map.items()],
+        )
+        STORE.execute("UPDATE nurture SET subscribed_after = 'no' WHERE subscribed_after = ''")
+    except Exception as e:
+        print(f">>> update_nurture_subscribed_after (SQLite) error: {e}")
+
+    if GS_NURTURE_WS is None:
+        return
 
     try:
         all_values = GS_NURTURE_WS.get_all_values()
@@ -1094,19 +3247,274 @@ def update_nurture_subscribed_after():
             print(">>> nurture sheet: нет нужных столбцов")
             return
 
+        column = []  # значения subscribed_after для строк 2..N
+        first_changed = None
+        last_changed = None
         for i in range(1, len(all_values)):
             row = all_values[i]
-            if len(row) <= max(idx_user, idx_sub_after):
-                continue
-            if row[idx_sub_after]:
+            current = row[idx_sub_after] if len(row) > idx_sub_after else ""
+            if current or len(row) <= idx_user:
+                column.append(current)
                 continue
             uid = row[idx_user].strip()
             status = sub_map.get(uid, "unsub")
-            val = "yes" if status == "sub" else "no"
-            GS_NURTURE_WS.update_cell(i + 1, idx_sub_after + 1, val)
+            column.append("yes" if status == "sub" else "no")
+            if first_changed is None:
+                first_changed = i
+            last_changed = i
+
+        if first_changed is None:
+            return
+
+        range_name = (
+            gspread.utils.rowcol_to_a1(first_changed + 1, idx_sub_after + 1)
+            + ":"
+            + gspread.utils.rowcol_to_a1(last_changed + 1, idx_sub_after + 1)
+        )
+        values = [[v] for v in column[first_changed - 1:last_changed]]
+        GS_NURTURE_WS.update(range_name=range_name, values=values, value_input_option="RAW")
+        print(f">>> update_nurture_subscribed_after: {range_name} ({len(values)} строк)")
     except Exception as e:
         print(f">>> update_nurture_subscribed_after (Sheets) error: {e}")
 
+# ===== подписка на канал =====
+
+CHANNEL_MEMBER_STATUSES = ("creator", "administrator", "member")
+
+
+def is_channel_member(cm) -> bool:
+    """ChatMember -> подписан ли пользователь (restricted тоже может быть участником)."""
+    if cm.status in CHANNEL_MEMBER_STATUSES:
+        return True
+    return cm.status == "restricted" and bool(getattr(cm, "is_member", False))
+
+
+class ChannelMembers:
+    """Статус подписки на CHANNEL_USERNAME: user_id -> sub / unsub.
+
+    Источник истины — апдейты chat_member (бот должен быть админом канала):
+    по ним статус записывается с source="event" и больше не перепроверяется.
+    get_chat_member дёргаем только для тех, по кому события ещё не было,
+    результат такого опроса сохраняем с source="poll" и считаем устаревшим
+    через ttl секунд после проверки (checked_at).
+    """
+
+    def __init__(self, store: EventStore):
+        self.store = store
+        self._lock = threading.Lock()
+        store.execute(
+            "CREATE TABLE IF NOT EXISTS channel_members ("
+            "user_id TEXT PRIMARY KEY, status TEXT NOT NULL, "
+            "source TEXT NOT NULL, updated_at TEXT NOT NULL, "
+            "checked_at REAL NOT NULL DEFAULT 0)"
+        )
+        columns = {r["name"] for r in store.query("PRAGMA table_info(channel_members)")}
+        if "checked_at" not in columns:
+            store.execute("ALTER TABLE channel_members ADD COLUMN checked_at REAL NOT NULL DEFAULT 0")
+        # user_id -> (status, source, checked_at)
+        self._entries: dict[str, tuple[str, str, float]] = {
+            r["user_id"]: (r["status"], r["source"], r["checked_at"])
+            for r in store.query("SELECT user_id, status, source, checked_at FROM channel_members")
+        }
+
+    def record(self, user_id, is_sub: bool, source: str) -> bool:
+        """Сохраняем статус; True, если он изменился."""
+        return bool(self.record_many({user_id: is_sub}, source))
+
+    def record_many(self, flags: dict, source: str) -> dict[str, bool]:
+        """Сохраняем пачку статусов {user_id: is_sub}; возвращаем те, что изменились."""
+        if not flags:
+            return {}
+        now = time_module.time()
+        now_iso = datetime.now(UTC).isoformat(timespec="seconds")
+        changed = {}
+        with self._lock:
+            for user_id, is_sub in flags.items():
+                uid = str(user_id)
+                status = "sub" if is_sub else "unsub"
+                previous = self._entries.get(uid)
+                self._entries[uid] = (status, source, now)
+                if previous is None or previous[0] != status:
+                    changed[uid] = is_sub
+        self.store.execute_many(
+            "INSERT INTO channel_members (user_id, status, source, updated_at, checked_at) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET status = excluded.status, source = excluded.source, "
+            "updated_at = excluded.updated_at, checked_at = excluded.checked_at",
+            [(str(uid), "sub" if is_sub else "unsub", source, now_iso, now) for uid, is_sub in flags.items()],
+        )
+        return changed
+
+    def cached(self, user_ids) -> tuple[dict[str, bool], float | None]:
+        """Известные статусы и время самой старой проверки опросом (None — всё по событиям)."""
+        statuses = {}
+        oldest = None
+        with self._lock:
+            for uid in user_ids:
+                entry = self._entries.get(str(uid))
+                if entry is None:
+                    continue
+                statuses[str(uid)] = entry[0] == "sub"
+                if entry[1] != "event" and (oldest is None or entry[2] < oldest):
+                    oldest = entry[2]
+        return statuses, oldest
+
+    def stale(self, user_ids, ttl: float) -> list[str]:
+        """Кого пора (пере)проверить: нет ни события, ни свежего опроса."""
+        threshold = time_module.time() - ttl
+        with self._lock:
+            return [
+                str(uid) for uid in user_ids
+                if uid and (
+                    (entry := self._entries.get(str(uid))) is None
+                    or (entry[1] != "event" and entry[2] < threshold)
+                )
+            ]
+
+    def count(self) -> tuple[int, int]:
+        """(по событиям, по опросу)."""
+        with self._lock:
+            events = sum(1 for entry in self._entries.values() if entry[1] == "event")
+            return events, len(self._entries) - events
+
+
+CHANNEL_MEMBERS = ChannelMembers(STORE)
+
+
+class MembershipRefresher:
+    """Перепроверка устаревших статусов подписки через get_chat_member.
+
+    Устаревшие id идут пачками по batch: внутри пачки не больше concurrency
+    запросов одновременно и не больше rate запросов в секунду на весь бот.
+    Итоги пачки сохраняются одним махом, изменившиеся статусы уходят в users.
+    Single-flight: одновременно идёт только один проход; кто пришёл во время
+    него, ждёт его конца и досматривает лишь тех, кого тот не покрыл.
+    """
+
+    def __init__(self, members: ChannelMembers, ttl: float, concurrency: int, rate: float, batch: int):
+        self.members = members
+        self.ttl = ttl
+        self.concurrency = concurrency
+        self.batch = batch
+        self.limiter = BroadcastRateLimiter(rate, per_chat_interval=0)
+        self._task: asyncio.Task | None = None
+        self._inflight: asyncio.Future | None = None  # завершится вместе с текущим проходом
+
+    @property
+    def running(self) -> bool:
+        return self._inflight is not None or (self._task is not None and not self._task.done())
+
+    def start(self, bot, user_ids):
+        """Запускаем проход в фоне, если он ещё не идёт."""
+        if not self.running:
+            self._task = asyncio.create_task(self._background(bot, list(user_ids)))
+
+    async def _background(self, bot, user_ids: list):
+        # у задачи своя копия контекста — приоритет фона не затронет вызвавший хендлер
+        GS_PRIORITY.set(GS_BACKGROUND)
+        try:
+            await self.refresh(bot, user_ids)
+        except Exception as e:
+            print(f">>> MembershipRefresher error: {e}")
+
+    async def _check(self, bot, uid: str, semaphore: asyncio.Semaphore) -> bool | None:
+        async with semaphore:
+            await self.limiter.wait(int(uid))
+            try:
+                cm = await bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=int(uid))
+                return is_channel_member(cm)
+            except RetryAfter as e:
+                self.limiter.pause(_retry_after_seconds(e))
+                return None
+            except BadRequest as e:
+                # пользователя нет / аккаунт удалён — считаем неподписанным
+                print(f"get_chat_member error for {uid}: {e}")
+                return False
+            except Exception as e:
+                print(f"get_chat_member error for {uid}: {e}")
+                return None
+
+    async def refresh(self, bot, user_ids) -> int:
+        """Проверяем устаревших из user_ids; возвращаем, сколько проверено."""
+        user_ids = list(user_ids)
+        while self._inflight is not None:
+            # shield: отмена ожидающего не должна отменять общий проход
+            await asyncio.shield(self._inflight)
+        stale = self.members.stale(user_ids, self.ttl)
+        if not stale or not CHANNEL_USERNAME:
+            return 0
+        inflight = self._inflight = asyncio.get_running_loop().create_future()
+        try:
+            return await self._refresh(bot, stale)
+        finally:
+            self._inflight = None
+            inflight.set_result(None)
+
+    async def _refresh(self, bot, stale: list) -> int:
+        started = time_module.monotonic()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        checked = 0
+        for i in range(0, len(stale), self.batch):
+            chunk = stale[i:i + self.batch]
+            results = await asyncio.gather(*(self._check(bot, uid, semaphore) for uid in chunk))
+            flags = {uid: is_sub for uid, is_sub in zip(chunk, results) if is_sub is not None}
+            checked += len(flags)
+            changed = await run_store(self.members.record_many, flags, "poll")
+            if changed:
+                await run_gs(set_subscribed_flags, changed)
+        print(f">>> MembershipRefresher: проверено {checked} из {len(stale)} "
+              f"за {time_module.monotonic() - started:.1f} с")
+        return checked
+
+
+MEMBERSHIP_REFRESHER = MembershipRefresher(
+    CHANNEL_MEMBERS, MEMBERSHIP_TTL, MEMBERSHIP_REFRESH_CONCURRENCY,
+    MEMBERSHIP_REFRESH_RATE, MEMBERSHIP_REFRESH_BATCH,
+)
+
+
+def format_age(seconds: float) -> str:
+    if seconds < 90:
+        return "только что"
+    if seconds < 90 * 60:
+        return f"{round(seconds / 60)} мин назад"
+    return f"{seconds / 3600:.1f} ч назад"
+
+
+def _is_our_channel(chat) -> bool:
+    if not CHANNEL_USERNAME:
+        return False
+    return (
+        str(chat.id) == CHANNEL_USERNAME
+        or (chat.username or "").lower() == CHANNEL_USERNAME.lstrip("@").lower()
+    )
+
+
+async def channel_statuses(bot, user_ids) -> dict[str, bool]:
+    """user_id -> подписан ли на канал (для джоб, которым нужен свежий статус).
+
+    Берём из CHANNEL_MEMBERS, предварительно перепроверив устаревших;
+    кого проверить не удалось, считаем неподписанными.
+    """
+    ids = [str(uid) for uid in user_ids if uid]
+    await MEMBERSHIP_REFRESHER.refresh(bot, ids)
+    statuses, _ = CHANNEL_MEMBERS.cached(ids)
+    return {uid: statuses.get(uid, False) for uid in ids}
+
+
+async def track_channel_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Апдейт chat_member: кто-то вступил в канал или вышел из него."""
+    cmu = update.chat_member
+    if cmu is None or not _is_our_channel(cmu.chat):
+        return
+    member = cmu.new_chat_member
+    uid = str(member.user.id)
+    is_sub = is_channel_member(member)
+    changed = await run_store(CHANNEL_MEMBERS.record, uid, is_sub, "event")
+    print(f">>> chat_member: {uid} -> {member.status}")
+    if changed:
+        await run_gs(set_subscribed_flags, {uid: is_sub})
+
 # ===== клиентские хендлеры =====
 
 
@@ -1201,12 +3609,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "а здесь жми кнопки ниже — начнём с карты и кубика."
         )
 
+    # пользователь снова пишет боту — можно снова слать ему рассылки
+    store_later(BLOCKED_USERS.unblock, user.id)
+
     # лог в Google Sheets
-    log_start_to_sheet(user, card_key)
+    store_later(log_start_to_sheet, user, card_key)
 
     # лог действия (вход)
     action_name = "enter_from_channel" if source == "channel" else "enter_bot"
-    log_action_to_sheet(user, action_name, source)
+    store_later(log_action_to_sheet, user, action_name, source)
 
     if update.message:
         await update.message.reply_text(text)
@@ -1254,7 +3665,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_data["meta_used"] = meta_used + 1
             await send_random_meta_card(update, context)
             # лог действия
-            log_action_to_sheet(user, "meta_card", "bot")
+            store_later(log_action_to_sheet, user, "meta_card", "bot")
 
         await query.edit_message_reply_markup(reply_markup=build_main_keyboard(user_data))
 
@@ -1296,7 +3707,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_data['last_dice_date'] = today
             
             await send_random_dice(update, context)
-            log_action_to_sheet(user, "dice", "bot")
+            store_later(log_action_to_sheet, user, "dice", "bot")
             
             await query.edit_message_text(
                 "🎲 *Ответ получен!*\n\n"
@@ -1313,7 +3724,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup=get_admin_keyboard())
 
     elif data == "st:reload_packs":
-        load_packs_from_sheets()
+        await run_gs(load_packs_from_sheets)
         count = len(PACKS_DATA)
         await query.message.reply_text(f"✅ Загружено {count} раскладов!")
         return
@@ -1367,7 +3778,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 print(f"send pack_select notify error to {admin_id}: {e}")
         
         # лог выбора расклада
-        log_action_to_sheet(user, "pack_select_other", "bot")
+        store_later(log_action_to_sheet, user, "pack_select_other", "bot")
         
         # вернуть пользователя к главному меню
         await query.edit_message_reply_markup(
@@ -1397,16 +3808,19 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
             else:
                 # Это локальный файл в папке packs_images
-                image_path = os.path.join(PACKS_DIR, filename)
+                image = ASSETS.get(PACKS_DIR, filename)
                 try:
-                    with open(image_path, "rb") as f:
-                        await query.message.reply_photo(
-                            photo=f,
-                            caption=text,
-                            reply_markup=InlineKeyboardMarkup(select_keyboard),
-                        )
+                    if image is None:
+                        raise FileNotFoundError(filename)
+                    await send_cached_photo(
+                        query.message.reply_photo,
+                        image["path"],
+                        caption=text,
+                        reply_markup=InlineKeyboardMarkup(select_keyboard),
+                    )
                 except FileNotFoundError:
-                    print(f"pack image not found: {image_path}")
+                    # файла нет в папке (или его удалили после последнего сканирования)
+                    print(f"pack image not found: {os.path.join(PACKS_DIR, filename)}")
                     await query.message.reply_text(
                         text,
                         reply_markup=InlineKeyboardMarkup(select_keyboard),
@@ -1450,7 +3864,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 print(f"send pack_select notify error to {admin_id}: {e}")
         
         # лог выбора расклада
-        log_action_to_sheet(user, "pack_select_other", "bot")
+        store_later(log_action_to_sheet, user, "pack_select_other", "bot")
         
         # вернуть пользователя к главному меню
         await query.edit_message_reply_markup(
@@ -1489,7 +3903,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 try:
                     worksheet = GS_AUTO_NURTURE_WS # <-- ИСПОЛЬЗУЕМ ГЛОБАЛЬНУЮ ПЕРЕМЕННУЮ
                     # Обновляем только ячейку с периодом (I1) - строка 1, используя правильный формат
-                    worksheet.update('I1', [[input_as_int]]) # <-- ИСПРАВЛЕНО: передаём как список списков
+                    await run_gs(worksheet.update, 'I1', [[input_as_int]]) # <-- ИСПРАВЛЕНО: передаём как список списков
                     await update.message.reply_text(f"✅ Период авторассылки обновлён на: <b>{input_as_int}</b> дней.", parse_mode='HTML') # <-- НОВОЕ
                     print(f"✅ Админ {admin_id} обновил период авторассылки до {input_as_int} дней.")
                     return # Завершаем обработку для админа
@@ -1514,7 +3928,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             worksheet = GS_AUTO_NURTURE_WS # <-- ИСПОЛЬЗУЕМ ГЛОБАЛЬНУЮ ПЕРЕМЕННУЮ
             # Обновляем только ячейку с текстом (H1) - строка 1, используя правильный формат
-            worksheet.update('H1', [[text_input]]) # <-- ИСПРАВЛЕНО: передаём как список списков
+            await run_gs(worksheet.update, 'H1', [[text_input]]) # <-- ИСПРАВЛЕНО: передаём как список списков
             import html # Импортируем модуль html
             escaped_for_html = html.escape(text_input) # Экранируем текст для HTML
             await update.message.reply_text(f"✅ Текст авторассылки обновлён:\n<code>{escaped_for_html}</code>", parse_mode='HTML') # <-- НОВОЕ
@@ -1582,6 +3996,15 @@ async def handle_stats_callback(update: Update, context: ContextTypes.DEFAULT_TY
     parts = data.split(":")
     action = parts[1]
 
+    # ===== остановка рассылки (кнопка в сообщении с прогрессом) =====
+    if action == "bc_cancel":
+        campaign_id = ":".join(parts[2:])
+        if await run_store(CAMPAIGNS.cancel, campaign_id):
+            await query.edit_message_text("⛔ Останавливаю рассылку после текущей пачки...")
+        else:
+            await query.edit_message_text("Рассылка уже завершена.")
+        return
+
     # --- НОВОЕ ДЕЙСТВИЕ ДЛЯ АВТОРАССЫЛКИ (исправлено для настроек в строке 1 и HTML) ---
     if action == "auto_nurture_menu":
         # Открываем меню управления авторассылкой
@@ -1592,7 +4015,7 @@ async def handle_stats_callback(update: Update, context: ContextTypes.DEFAULT_TY
         else:
             try:
                 worksheet = GS_AUTO_NURTURE_WS
-                settings_row = worksheet.row_values(1) # <-- ПРАВИЛЬНО: строка 1
+                settings_row = await run_gs(worksheet.row_values, 1) # <-- ПРАВИЛЬНО: строка 1
                 current_text = settings_row[7] if len(settings_row) > 7 else "" # <-- ПРАВИЛЬНО: колонка H (индекс 7)
                 current_period = settings_row[8] if len(settings_row) > 8 else "" # <-- ПРАВИЛЬНО: колонка I (индекс 8)
             except gspread.exceptions.WorksheetNotFound:
@@ -1705,7 +4128,7 @@ async def handle_stats_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     # ===== reload_packs =====
     if action == "reload_packs":
-        load_packs_from_sheets()
+        await run_gs(load_packs_from_sheets)
         count = len(PACKS_DATA)
         await query.answer(f"✅ Загружено {count} раскладов!", show_alert=True)
         return
@@ -1735,6 +4158,7 @@ async def handle_stats_callback(update: Update, context: ContextTypes.DEFAULT_TY
             [InlineKeyboardButton("🧭 Действия: сегодня", callback_data="st:actions:today")],
             [InlineKeyboardButton("🧭 Действия: вчера", callback_data="st:actions:yesterday")],
             [InlineKeyboardButton("🧭 Действия: 7 дней", callback_data="st:actions:7days")],
+            [InlineKeyboardButton("🗄 Кэш", callback_data="st:cache")],
             [InlineKeyboardButton("⬅️ Назад в админ-меню", callback_data="st:menu")],
         ]
         await query.edit_message_text(
@@ -1743,6 +4167,23 @@ async def handle_stats_callback(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return
      
+    # ===== cache =====
+    if action in ("cache", "cache_reset"):
+        if action == "cache_reset":
+            for cache in ROW_CACHES.values():
+                cache.invalidate(drop=True)
+        keyboard = [
+            [InlineKeyboardButton("🧹 Сбросить кэш", callback_data="st:cache_reset")],
+            [InlineKeyboardButton("⬅️ Назад", callback_data="st:stats_menu")],
+        ]
+        await query.edit_message_text(
+            build_cache_stats(),
+            reply_markup=InlineKeyboardMarkup(keyboard),
+        )
+        if action == "cache_reset":
+            await query.answer("Кэш сброшен, данные перечитаются из базы.", show_alert=True)
+        return
+
     # ===== reset_attempts =====
     if action == "reset_attempts":
         user_data = context.user_data
@@ -1759,7 +4200,7 @@ async def handle_stats_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
     # ===== nurture =====
     if action == "nurture":
-        text = build_nurture_stats(days=7)
+        text = await run_store(build_nurture_stats, days=7)
         await query.edit_message_text(
             text,
             parse_mode=ParseMode.MARKDOWN_V2,
@@ -1782,7 +4223,7 @@ async def handle_stats_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     # ===== users_last =====
     if action == "users_last":
-        text = build_users_list(sort_by="last")
+        text = await run_store(build_users_list, sort_by="last")
         await query.edit_message_text(
             text,
             parse_mode=ParseMode.MARKDOWN_V2,
@@ -1792,7 +4233,7 @@ async def handle_stats_callback(update: Update, context: ContextTypes.DEFAULT_TY
     
     # ===== users_first =====
     if action == "users_first":
-        text = build_users_list(sort_by="first")
+        text = await run_store(build_users_list, sort_by="first")
         await query.edit_message_text(
             text,
             parse_mode=ParseMode.MARKDOWN_V2,
@@ -1804,7 +4245,7 @@ async def handle_stats_callback(update: Update, context: ContextTypes.DEFAULT_TY
     # ===== actions =====
     if action == "actions":
         period = parts[2] if len(parts) > 2 else "today"
-        text = build_actions_stats(period)
+        text = await run_store(build_actions_stats, period)
         await query.edit_message_text(
             text,
             parse_mode=ParseMode.MARKDOWN_V2,
@@ -1835,7 +4276,7 @@ async def handle_stats_callback(update: Update, context: ContextTypes.DEFAULT_TY
         start_dt = y.replace(hour=0, minute=0, second=0, microsecond=0)
         end_dt = y.replace(hour=23, minute=59, second=59, microsecond=0)
     elif action == "7days":
-        start_dt = now - timedelta(days=7)
+        start_dt = (now - timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
         end_dt = now
     elif action == "alltime":
         start_dt = datetime(2000, 1, 1, tzinfo=UTC)
@@ -1854,10 +4295,6 @@ async def handle_stats_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
 
 def build_actions_stats(period: str) -> str:
-    rows = get_cached_actions()  # ← БЫЛО: load_actions()
-    if not rows:
-        return esc_md2("Лог действий пока пуст.")
-
     now = datetime.now(UTC)
 
     if period == "today":
@@ -1870,7 +4307,8 @@ def build_actions_stats(period: str) -> str:
         end_dt = y.replace(hour=23, minute=59, second=59, microsecond=0)
         period_str = f"{start_dt.date()}"
     elif period == "7days":
-        start_dt = now - timedelta(days=7)
+        # целые дни, чтобы итоги совпадали с дневными агрегатами
+        start_dt = (now - timedelta(days=7)).replace(hour=0, minute=0, second=0, microsecond=0)
         end_dt = now
         period_str = f"{start_dt.date()} — {end_dt.date()}"
     else:
@@ -1878,22 +4316,23 @@ def build_actions_stats(period: str) -> str:
         end_dt = now
         period_str = "за всё время"
 
-    filtered = []
-    for r in rows:
-        dt = parse_iso(r["ts_iso"])
-        if dt is None:
-            continue
-        if not (start_dt <= dt <= end_dt):
-            continue
-        filtered.append(r)
+    start_ts, end_ts = start_dt.timestamp(), end_dt.timestamp()
+    if period in ("today", "yesterday", "7days"):
+        # только дни периода из дневных корзин кэша
+        filtered = ACTIONS_CACHE.rows_between(start_ts, end_ts)
+    else:
+        rows = get_cached_actions()
+        if not rows:
+            return esc_md2("Лог действий пока пуст.")
+        filtered = [r for r in rows if r["ts"] is not None and start_ts <= r["ts"] <= end_ts]
 
     if not filtered:
         return esc_md2(f"В период {period_str} действий не было.")
 
-    total = len(filtered)
     by_action = defaultdict(int)
-    for r in filtered:
-        by_action[r["action"]] += 1
+    for r in STORE.daily_counts(ACTIONS_SHEET_NAME, start_dt.date().isoformat(), end_dt.date().isoformat()):
+        by_action[r["action"]] += r["count"]
+    total = sum(by_action.values())
 
     header = esc_md2(f"Действия пользователей за {period_str}")
     lines = [header, ""]
@@ -1904,7 +4343,7 @@ def build_actions_stats(period: str) -> str:
     lines.append("")
     lines.append(esc_md2("Пользователи и их действия:"))
 
-    filtered_sorted = sorted(filtered, key=lambda r: r["ts_iso"])
+    filtered_sorted = sorted(filtered, key=lambda r: r["ts"])
     for r in filtered_sorted:
         uid = r["user_id"]
         username = r["username"]
@@ -1931,36 +4370,26 @@ async def build_stats_text(context: ContextTypes.DEFAULT_TYPE,
                            end_dt: datetime,
                            card_filter: str) -> str:
     bot = context.bot
-    users = load_users()
-    if not users:
+    timeline = await run_store(USER_TIMELINE.snapshot)
+    if not timeline:
         return esc_md2("Пока нет данных по переходам.")
 
-    channel_id = CHANNEL_USERNAME
-
-    unique_ids = {row["user_id"] for row in users}
-    real_status: dict[str, str] = {}
-    for uid in unique_ids:
-        if not uid:
-            continue
-        try:
-            cm = await bot.get_chat_member(chat_id=channel_id, user_id=int(uid))
-            if cm.status in ("creator", "administrator", "member"):
-                real_status[uid] = "sub"
-                update_subscribed_flag(int(uid), True)
-            else:
-                real_status[uid] = "unsub"
-                update_subscribed_flag(int(uid), False)
-        except Exception as e:
-            print(f"get_chat_member error for {uid}: {e}")
-            real_status[uid] = "unsub"
-            update_subscribed_flag(int(uid), False)
+    # статусы — сразу из кэша, устаревшие перепроверяются в фоне
+    flags, checked_at = CHANNEL_MEMBERS.cached(timeline)
+    real_status = {uid: "sub" if is_sub else "unsub" for uid, is_sub in flags.items()}
+    pending = len(CHANNEL_MEMBERS.stale(timeline, MEMBERSHIP_TTL))
+    if pending:
+        MEMBERSHIP_REFRESHER.start(bot, timeline)
 
+    # строки переходов читаем только за выбранный период
+    users = await run_store(load_users, since=start_dt.isoformat(timespec="seconds"))
+    start_ts, end_ts = start_dt.timestamp(), end_dt.timestamp()
     filtered = []
     for row in users:
-        dt = parse_iso(row["date_iso"])
-        if dt is None:
+        ts = row["ts"]
+        if ts is None:
             continue
-        if not (start_dt <= dt <= end_dt):
+        if not (start_ts <= ts <= end_ts):
             continue
         if card_filter != "all" and row["card_key"] != card_filter:
             continue
@@ -1969,19 +4398,24 @@ async def build_stats_text(context: ContextTypes.DEFAULT_TYPE,
     if not filtered:
         return esc_md2("В выбранный период переходов не было.")
 
-    total_clicks = len(filtered)
     unique_users = {r["user_id"] for r in filtered}
 
     sub_users = {uid for uid in unique_users if real_status.get(uid) == "sub"}
     unsub_users = unique_users - sub_users
 
+    # переходы по картам — из дневных агрегатов, подписчики — по строкам периода
     per_card_clicks = defaultdict(int)
+    daily = await run_store(STORE.daily_counts, USERS_SHEET_NAME, start_dt.date().isoformat(), end_dt.date().isoformat())
+    for r in daily:
+        if card_filter != "all" and r["card_key"] != card_filter:
+            continue
+        per_card_clicks[r["card_key"] or "-"] += r["count"]
+    total_clicks = sum(per_card_clicks.values())
+
     per_card_subs = defaultdict(int)
     for row in filtered:
-        ck = row["card_key"] or "-"
-        per_card_clicks[ck] += 1
         if real_status.get(row["user_id"]) == "sub":
-            per_card_subs[ck] += 1
+            per_card_subs[row["card_key"] or "-"] += 1
 
     period_str = f"{start_dt.date()} — {end_dt.date()}"
     if start_dt.date() == end_dt.date():
@@ -2003,6 +4437,13 @@ async def build_stats_text(context: ContextTypes.DEFAULT_TYPE,
         conv = round(len(sub_users) / total_clicks * 100, 1)
         lines.append(esc_md2(f"Общая конверсия: {conv}%"))
 
+    status_line = "Статусы подписки: " + (
+        f"проверены {format_age(time_module.time() - checked_at)}" if checked_at else "по событиям канала"
+    )
+    if pending:
+        status_line += f", обновляются в фоне ({pending} ждут проверки)"
+    lines.append(esc_md2(status_line))
+
     lines.append("")
     lines.append(esc_md2("По картам:"))
 
@@ -2015,7 +4456,7 @@ async def build_stats_text(context: ContextTypes.DEFAULT_TYPE,
     lines.append("")
     lines.append(esc_md2("Список пользователей:"))
 
-    filtered_sorted = sorted(filtered, key=lambda r: r["date_iso"])
+    filtered_sorted = sorted(filtered, key=lambda r: r["ts"])
 
     for row in filtered_sorted:
         uid = row["user_id"]
@@ -2036,30 +4477,26 @@ async def build_stats_text(context: ContextTypes.DEFAULT_TYPE,
 
 
 def build_nurture_stats(days: int = 7) -> str:
-    rows = load_nurture_rows()
-    if not rows:
-        return esc_md2("Лог автоворонки пока пуст.")
-
     now = datetime.now(UTC)
-    since = now - timedelta(days=days)
+    since_day = (now - timedelta(days=days)).date().isoformat()
 
     total_sent = 0
     by_segment = defaultdict(int)
-    by_segment_conv = defaultdict(int)
     by_day_segment = defaultdict(int)
-
-    for r in rows:
-        sent_at = parse_iso(r["sent_at"])
-        if sent_at is None or sent_at < since:
-            continue
-        total_sent += 1
+    for r in STORE.daily_counts(NURTURE_SHEET_NAME, since_day):
         seg = r["segment"]
-        day_num = r["day_num"]
-        by_segment[seg] += 1
-        key = f"{seg}_day_{day_num}"
-        by_day_segment[key] += 1
-        if r.get("subscribed_after") == "yes":
-            by_segment_conv[seg] += 1
+        total_sent += r["count"]
+        by_segment[seg] += r["count"]
+        by_day_segment[f"{seg}_{r['action']}"] += r["count"]
+
+    # subscribed_after проставляется позже отправки, поэтому его считаем по таблице
+    by_segment_conv = defaultdict(int)
+    for r in STORE.query(
+        "SELECT segment, COUNT(*) AS n FROM nurture WHERE sent_at >= ? AND subscribed_after = 'yes' "
+        "GROUP BY segment",
+        (since_day,),
+    ):
+        by_segment_conv[r["segment"]] = r["n"]
 
     if total_sent == 0:
         return esc_md2(f"За последние {days} дней nurture‑сообщений не отправлялось.")
@@ -2082,36 +4519,8 @@ def build_nurture_stats(days: int = 7) -> str:
 
 def build_users_list(sort_by="last") -> str:
     """Список пользователей с первым и последним входом."""
-    users = get_cached_users()  # ← БЫЛО: load_users()
-    if not users:
-        return esc_md2("Пока нет пользователей в боте.")
-    
-    # Группируем по user_id, берём первый и последний вход
-    by_user = {}
-    for row in users:
-        uid = row["user_id"].strip()
-        if not uid:
-            continue
-        
-        dt = parse_iso(row["date_iso"])
-        if dt is None:
-            continue
-        
-        username = row.get("username", "").strip()
-        first_name = row.get("first_name", "").strip()
-        
-        if uid not in by_user:
-            by_user[uid] = {
-                "username": username,
-                "first_name": first_name,
-                "first_dt": dt,
-                "last_dt": dt,
-            }
-        else:
-            if dt < by_user[uid]["first_dt"]:
-                by_user[uid]["first_dt"] = dt
-            if dt > by_user[uid]["last_dt"]:
-                by_user[uid]["last_dt"] = dt
+    # первый/последний вход по каждому user_id уже посчитан в индексе
+    by_user = USER_TIMELINE.snapshot()
     
     if not by_user:
         return esc_md2("Нет корректных данных о пользователях.")
@@ -2156,7 +4565,8 @@ def build_users_list(sort_by="last") -> str:
 async def notify_admins_once(context: ContextTypes.DEFAULT_TYPE, force: bool = False):
     now = datetime.now(UTC)
     last_ts = load_last_report_ts()
-    users = load_users()
+    # из базы берём только строки после прошлого отчёта (индекс по date_iso)
+    users = await run_store(load_users, since=last_ts.isoformat(timespec="seconds"))
     if not users:
         if force:
             text = "🔔 Проверка автоуведомления.\nНовых переходов и подписчиков нет."
@@ -2168,12 +4578,13 @@ async def notify_admins_once(context: ContextTypes.DEFAULT_TYPE, force: bool = F
         save_last_report_ts(now)
         return
 
+    last_epoch = last_ts.timestamp()
     new_rows = []
     for row in users:
-        dt = parse_iso(row["date_iso"])
-        if dt is None:
+        ts = row["ts"]
+        if ts is None:
             continue
-        if dt > last_ts:
+        if ts > last_epoch:
             new_rows.append(row)
 
     if not new_rows and not force:
@@ -2185,21 +4596,10 @@ async def notify_admins_once(context: ContextTypes.DEFAULT_TYPE, force: bool = F
     for r in new_rows:
         per_card_clicks[r["card_key"] or "-"] += 1
 
-    bot = context.bot
-    channel_id = CHANNEL_USERNAME
-    unique_ids = {r["user_id"] for r in new_rows}
-    new_subs = set()
-
-    for uid in unique_ids:
-        if not uid:
-            continue
-        try:
-            cm = await bot.get_chat_member(chat_id=channel_id, user_id=int(uid))
-            if cm.status in ("creator", "administrator", "member"):
-                new_subs.add(uid)
-                update_subscribed_flag(int(uid), True)
-        except Exception as e:
-            print(f"notify get_chat_member error for {uid}: {e}")
+    unique_ids = USER_TIMELINE.active_since(last_ts)
+    flags = await channel_statuses(context.bot, unique_ids)
+    new_subs = {uid for uid, is_sub in flags.items() if is_sub}
+    await run_gs(set_subscribed_flags, {uid: True for uid in new_subs})
 
     if not new_rows and force:
         text = (
@@ -2227,6 +4627,7 @@ async def notify_admins_once(context: ContextTypes.DEFAULT_TYPE, force: bool = F
 
 
 async def notify_admins(context: ContextTypes.DEFAULT_TYPE):
+    GS_PRIORITY.set(GS_BACKGROUND)
     await notify_admins_once(context, force=False)
 
 
@@ -2242,50 +4643,39 @@ async def debug_notify(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ===== автоворонка nurture (sub / unsub) =====
 
 
+async def membership_refresh_job(context: ContextTypes.DEFAULT_TYPE):
+    if MEMBERSHIP_REFRESHER.running:
+        return
+    by_user = await run_store(USER_TIMELINE.snapshot)
+    MEMBERSHIP_REFRESHER.start(context.bot, by_user)
+
+
+async def compact_actions_job(context: ContextTypes.DEFAULT_TYPE):
+    GS_PRIORITY.set(GS_BACKGROUND)
+    result = await run_gs(compact_actions)
+    print(f">>> compact_actions: {result}")
+
+
 async def nurture_job(context: ContextTypes.DEFAULT_TYPE):
-    users = load_users()
-    if not users:
+    GS_PRIORITY.set(GS_BACKGROUND)
+    by_user = await run_store(USER_TIMELINE.snapshot)
+    if not by_user:
         return
 
     now = datetime.now(UTC)
     bot = context.bot
-    channel_id = CHANNEL_USERNAME
-
-    by_user = {}
-    for row in users:
-        uid = row["user_id"]
-        dt = parse_iso(row["date_iso"])
-        if dt is None or not uid:
-            continue
-        if uid not in by_user:
-            by_user[uid] = {
-                "first_dt": dt,
-                "last_row": row,
-            }
-        else:
-            if dt < by_user[uid]["first_dt"]:
-                by_user[uid]["first_dt"] = dt
-            last_dt = parse_iso(by_user[uid]["last_row"]["date_iso"])
-            if last_dt is None or dt > last_dt:
-                by_user[uid]["last_row"] = row
 
-    for uid, info in by_user.items():
+    candidates = {
+        uid: info for uid, info in by_user.items()
+        if info["card_key"] in CARD_KEYS and not BLOCKED_USERS.is_blocked(uid)
+    }
+    sub_flags = await channel_statuses(bot, candidates)
+    for uid, info in candidates.items():
         first_dt = info["first_dt"]
-        row = info["last_row"]
-        card_key = row["card_key"]
-        if not card_key or card_key not in CARD_KEYS:
-            continue
+        card_key = info["card_key"]
 
         days = (now.date() - first_dt.date()).days
-
-        try:
-            cm = await bot.get_chat_member(chat_id=channel_id, user_id=int(uid))
-            is_sub = cm.status in ("creator", "administrator", "member")
-            update_subscribed_flag(int(uid), is_sub)
-        except Exception as e:
-            print(f"nurture get_chat_member error for {uid}: {e}")
-            is_sub = False
-            update_subscribed_flag(int(uid), False)
+        is_sub = sub_flags.get(uid, False)
 
         if not is_sub and days in (1, 3, 7):
             day_num = days
@@ -2296,10 +4686,12 @@ async def nurture_job(context: ContextTypes.DEFAULT_TYPE):
                 text = msg_template.format(channel=CHANNEL_USERNAME)
                 try:
                     await bot.send_message(chat_id=int(uid), text=text)
-                    log_nurture_to_sheet(int(uid), card_key, "unsub", day_num, "ok")
+                    store_later(log_nurture_to_sheet, int(uid), card_key, "unsub", day_num, "ok")
                 except Exception as e:
                     print(f"nurture unsub send error to {uid}: {e}")
-                    log_nurture_to_sheet(int(uid), card_key, "unsub", day_num, "error", str(e))
+                    store_later(log_nurture_to_sheet, int(uid), card_key, "unsub", day_num, "error", str(e))
+                    if is_dead_chat_error(e):
+                        await run_store(BLOCKED_USERS.mark, uid, e)
 
         if is_sub and days in (3, 7, 14):
             day_num = days
@@ -2310,23 +4702,29 @@ async def nurture_job(context: ContextTypes.DEFAULT_TYPE):
                 text = msg_template.format(channel=CHANNEL_USERNAME)
                 try:
                     await bot.send_message(chat_id=int(uid), text=text)
-                    log_nurture_to_sheet(int(uid), card_key, "sub", day_num, "ok")
+                    store_later(log_nurture_to_sheet, int(uid), card_key, "sub", day_num, "ok")
                 except Exception as e:
                     print(f"nurture sub send error to {uid}: {e}")
-                    log_nurture_to_sheet(int(uid), card_key, "sub", day_num, "error", str(e))
+                    store_later(log_nurture_to_sheet, int(uid), card_key, "sub", day_num, "error", str(e))
+                    if is_dead_chat_error(e):
+                        await run_store(BLOCKED_USERS.mark, uid, e)
+
+    await run_gs(set_subscribed_flags, sub_flags)
 
-    update_nurture_subscribed_after()
+    # nurture-строки должны уже быть в листе, прежде чем проставлять subscribed_after
+    await run_gs(REPLICATOR.flush)
+    await run_gs(update_nurture_subscribed_after)
 
 # ===== ежедневное напоминание пользователям =====
 
 
 async def daily_reminder_job(context: ContextTypes.DEFAULT_TYPE):
-    users = load_users()
-    if not users:
+    GS_PRIORITY.set(GS_BACKGROUND)
+    by_user = await run_store(USER_TIMELINE.snapshot)
+    if not by_user:
         return
 
-    bot = context.bot
-    unique_ids = {int(row["user_id"]) for row in users if row.get("user_id")}
+    unique_ids = [int(uid) for uid in by_user if uid.isdigit()]
 
     text = (
         "Доброе утро! 🌅\n\n"
@@ -2338,24 +4736,73 @@ async def daily_reminder_job(context: ContextTypes.DEFAULT_TYPE):
         "просто напиши «РАСКЛАД» в ответ на сообщение бота."
     )
 
-    for uid in unique_ids:
-        try:
-            await bot.send_message(chat_id=uid, text=text)
-        except Exception as e:
-            print(f"daily_reminder_job send error to {uid}: {e}")
+    # не всем сразу: каждому пользователю — свой постоянный слот в окне DAILY_REMINDER_WINDOW,
+    # так утренняя рассылка не упирается в лимиты сразу после карты дня
+    today = datetime.now(UTC).strftime("%Y-%m-%d")
+    campaign_id = f"daily_reminder:{today}"
+    created = await run_store(
+        CAMPAIGNS.create, campaign_id, "daily_reminder",
+        {"text": text, "name": "daily_reminder", "window": DAILY_REMINDER_WINDOW, "start": time_module.time()},
+        unique_ids,
+    )
+    if not created:
+        print(f"ℹ️ Кампания {campaign_id} уже создана — повторно не запускаем.")
+        return
+    print(f">>> daily_reminder_job: {len(unique_ids)} получателей в окне {DAILY_REMINDER_WINDOW // 60} мин")
+    await run_campaign(context.bot, campaign_id)
 
 # ===== входная точка =====
 
 
+async def on_shutdown(application: Application):
+    """Отправляем в Sheets неотреплицированные строки перед остановкой процесса."""
+    await run_gs(REPLICATOR.stop)
+    GS_EXECUTOR.shutdown(wait=False)
+    GS_BACKGROUND_EXECUTOR.shutdown(wait=False)
+    STORE_EXECUTOR.shutdown(wait=False)
+
+
 def main():
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN не задан")
+    if not os.getenv("DB_PATH"):
+        print(
+            f"⚠️⚠️⚠️ DB_PATH не задан — база событий лежит рядом с bot.py: {DB_PATH}\n"
+            "⚠️⚠️⚠️ На Render этот файл пропадёт при деплое/рестарте: события заново зальются из Sheets, "
+            "а прогресс рассылок, заблокировавшие бота, file_id картинок и статусы подписки потеряются. "
+            "Подключите persistent disk и задайте DB_PATH=/<mount>/tarot_bot.sqlite3"
+        )
 
     # инициализируем Google Sheets
     init_gs_client()
     load_packs_from_sheets()
+    try:
+        ACTIONS_PARTITIONS.bind(GS_SHEET)
+    except Exception as e:
+        print(f">>> ActionsPartitions: ошибка чтения списка вкладок: {e}")
+    import_sheets_to_store()
+    USER_TIMELINE.ensure_loaded()
+    ASSETS.load()
+    # копии картинок готовим в фоне: пока копии нет, path_for сделает её при первой загрузке
+    threading.Thread(
+        target=IMAGE_DERIVATIVES.build_all, args=(ASSETS.all_paths(),),
+        name="image-derivatives", daemon=True,
+    ).start()
+    REPLICATOR.attach(USERS_SHEET_NAME, GS_USERS_WS)
+    if GS_SHEET is not None:
+        REPLICATOR.attach_partitioned(ACTIONS_SHEET_NAME, ACTIONS_PARTITIONS.for_record)
+    REPLICATOR.attach(NURTURE_SHEET_NAME, GS_NURTURE_WS)
+    REPLICATOR.attach(AUTO_NURTURE_SHEET_NAME, GS_AUTO_NURTURE_WS)
+    REPLICATOR.attach(AUTO_NURTURE_TEXTS_SHEET_NAME, GS_AUTO_NURTURE_TEXTS_WS)
+    REPLICATOR.add_listener(USERS_SHEET_NAME, USERS_INDEX.on_rows_appended)
+    try:
+        DAILY_STATS_SYNC.bind(GS_DAILY_STATS_WS)
+    except Exception as e:
+        print(f">>> DailyStatsSheetSync: ошибка подключения вкладки: {e}")
+    REPLICATOR.add_flush_hook(DAILY_STATS_SYNC.flush)
+    REPLICATOR.start()
 
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = Application.builder().token(BOT_TOKEN).post_shutdown(on_shutdown).build()
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("admin", admin_menu))
@@ -2364,6 +4811,8 @@ def main():
     app.add_handler(CallbackQueryHandler(button))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     app.add_handler(CommandHandler("reload_packs", reload_packs))
+    app.add_handler(CommandHandler("warm_media", warm_media))
+    app.add_handler(ChatMemberHandler(track_channel_member, ChatMemberHandler.CHAT_MEMBER))
 
     print(">>> Starting bot with built‑in webhook server")
 
@@ -2392,6 +4841,28 @@ def main():
         time=dt_time(4, 6),  # В Москве на 3 часа больше
         name="daily_reminder",
     )
+    job_queue.run_once(
+        resume_campaigns_job,
+        when=15,
+        name="resume_campaigns",
+    )
+    job_queue.run_repeating(
+        membership_refresh_job,
+        interval=MEMBERSHIP_REFRESH_INTERVAL,
+        first=120,
+        name="membership_refresh",
+    )
+    if MEDIA_WARMUP_CHAT_ID and MEDIA_WARMUP_ON_START:
+        job_queue.run_once(
+            warm_media_job,
+            when=30,
+            name="warm_media",
+        )
+    job_queue.run_daily(
+        compact_actions_job,
+        time=dt_time(3, 30),
+        name="compact_actions",
+    )
 
     # --- ПЛАНИРОВАНИЕ ДЖОБЫ ---
     job_queue = app.job_queue
@@ -2409,7 +4880,8 @@ def main():
         port=PORT,
         url_path="",
         webhook_url=base_url,
-        allowed_updates=None,
+        # только то, на что есть хендлеры; chat_member Telegram присылает, только если попросить явно
+        allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER],
     )
 
 
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# bot.py открывает базу при импорте — уводим её во временный каталог
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="tarot-bot-tests-"), "bot.sqlite3"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("gspread")
+bot = pytest.importorskip("bot")
+
+
+@pytest.fixture
+def campaigns(tmp_path, monkeypatch):
+    campaigns = bot.BroadcastCampaigns(bot.EventStore(str(tmp_path / "events.sqlite3")))
+    monkeypatch.setattr(bot, "CAMPAIGNS", campaigns)
+    return campaigns
+
+
+class RecordingKind(bot.CampaignKind):
+    progress_interval = 0
+
+    def __init__(self):
+        self.sent = []
+        self.finished = None
+
+    async def send(self, bot_, payload, chat_id):
+        self.sent.append(chat_id)
+
+    async def on_finish(self, bot_, payload, stats, cancelled=False):
+        self.finished = stats
+
+
+def _statuses(campaigns, campaign_id):
+    rows = campaigns.store.query(
+        "SELECT user_id, status FROM broadcast_recipients WHERE campaign_id = ? ORDER BY position",
+        (campaign_id,),
+    )
+    return {r["user_id"]: r["status"] for r in rows}
+
+
+def test_create_is_idempotent(campaigns):
+    assert campaigns.create("c1", "admin_text", {"text": "hi"}, [1, 2, 2, 3])
+    assert not campaigns.create("c1", "admin_text", {"text": "other"}, [4])
+    assert campaigns.get("c1")["payload"] == {"text": "hi"}
+    assert _statuses(campaigns, "c1") == {1: "pending", 2: "pending", 3: "pending"}
+
+
+def test_claim_hands_out_each_recipient_once(campaigns):
+    campaigns.create("c1", "admin_text", {"text": "hi"}, list(range(1, 6)))
+    first = campaigns.claim("c1", 3)
+    second = campaigns.claim("c1", 3)
+    assert first == [1, 2, 3]
+    assert second == [4, 5]
+    assert campaigns.claim("c1", 3) == []
+    assert campaigns.next_due("c1") is None
+
+
+def test_claim_waits_for_the_window_slot(campaigns, monkeypatch):
+    monkeypatch.setattr(bot, "spread_slot", lambda uid, window: uid * 100)
+    start = bot.time_module.time()
+    campaigns.create("w", "daily_reminder", {"text": "hi", "window": 1000, "start": start}, [0, 1, 2])
+    assert campaigns.claim("w", 10) == [0]
+    assert campaigns.next_due("w") == pytest.approx(start + 100)
+
+
+def test_recover_never_resends_an_interrupted_chunk(campaigns):
+    campaigns.create("c1", "admin_text", {"text": "hi"}, [1, 2, 3, 4])
+    chunk = campaigns.claim("c1", 2)
+    campaigns.checkpoint("c1", [(chunk[0], None)])
+    # процесс умер: chunk[1] остался 'sending'
+    assert campaigns.recover("c1") == 1
+    assert _statuses(campaigns, "c1") == {1: "sent", 2: "unknown", 3: "pending", 4: "pending"}
+    assert campaigns.claim("c1", 10) == [3, 4]
+
+    stats = campaigns.stats("c1")
+    assert (stats.total, stats.sent, stats.unknown) == (4, 1, 1)
+
+
+def test_run_campaign_resumes_without_duplicates(campaigns, monkeypatch):
+    kind = RecordingKind()
+    monkeypatch.setitem(bot.CAMPAIGN_KINDS, "recording", kind)
+    monkeypatch.setattr(bot, "BROADCAST_CHECKPOINT_EVERY", 2)
+    campaigns.create("c1", "recording", {}, [1, 2, 3, 4, 5])
+    campaigns.claim("c1", 2)
+    campaigns.checkpoint("c1", [(1, None)])
+    campaigns.recover("c1")
+
+    asyncio.run(bot.run_campaign(None, "c1"))
+    assert sorted(kind.sent) == [3, 4, 5]
+    assert (kind.finished.sent, kind.finished.unknown) == (4, 1)
+    assert campaigns.get("c1")["status"] == "done"
+
+    asyncio.run(bot.run_campaign(None, "c1"))  # завершённую кампанию повторно не шлём
+    assert sorted(kind.sent) == [3, 4, 5]
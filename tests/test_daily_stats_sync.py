@@ -0,0 +1,111 @@
+import re
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("gspread")
+bot = pytest.importorskip("bot")
+
+
+class FakeWorksheet:
+    """Вкладка в памяти: values[0] — заголовок, номер строки = индекс + 1."""
+
+    def __init__(self, values=None, report_range=True):
+        self.values = [list(r) for r in (values or [])]
+        self.report_range = report_range
+        self.appends = 0
+        self.updates = 0
+
+    def get_all_values(self):
+        return [list(r) for r in self.values]
+
+    def append_row(self, row, value_input_option=None):
+        self.values.append([str(v) for v in row])
+
+    def append_rows(self, rows, value_input_option=None):
+        self.appends += 1
+        start = len(self.values) + 1
+        self.values.extend([str(v) for v in row] for row in rows)
+        if not self.report_range:
+            return {}
+        return {"updates": {"updatedRange": f"daily_stats!A{start}:G{len(self.values)}"}}
+
+    def batch_update(self, data, value_input_option=None):
+        self.updates += 1
+        for item in data:
+            match = re.match(r"([A-Z]+)(\d+)", item["range"])
+            col = sum((ord(ch) - 64) * 26 ** i for i, ch in enumerate(reversed(match.group(1))))
+            row = self.values[int(match.group(2)) - 1]
+            row[col - 1] = str(item["values"][0][0])
+
+
+def _action(user_id, action, ts_iso):
+    return [str(user_id), "", "", action, "bot", ts_iso]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return bot.EventStore(str(tmp_path / "events.sqlite3"))
+
+
+def _sheet_counts(ws):
+    return {tuple(r[:len(bot.DAILY_STATS_KEY)]): int(r[-1]) for r in ws.values[1:]}
+
+
+def _dirty(store):
+    return store.query("SELECT COUNT(*) AS n FROM daily_stats WHERE dirty = 1")[0]["n"]
+
+
+def test_new_keys_are_appended_then_updated_in_place(store):
+    sync = bot.DailyStatsSheetSync(store)
+    ws = FakeWorksheet()
+    sync.bind(ws)
+
+    store.insert_many(bot.ACTIONS_SHEET_NAME, [
+        _action(1, "meta_card", "2024-05-01T10:00:00+00:00"),
+        _action(2, "meta_card", "2024-05-01T11:00:00+00:00"),
+        _action(1, "dice", "2024-05-02T10:00:00+00:00"),
+    ])
+    sync.flush()
+    assert ws.appends == 1
+    assert sorted(_sheet_counts(ws).values()) == [1, 2]
+    assert _dirty(store) == 0
+
+    store.insert_many(bot.ACTIONS_SHEET_NAME, [_action(3, "dice", "2024-05-02T12:00:00+00:00")])
+    sync.flush()
+    assert ws.appends == 1  # существующий ключ переписан на месте
+    assert ws.updates == 1
+    assert len(ws.values) == 3
+    assert sorted(_sheet_counts(ws).values()) == [2, 2]
+    assert _dirty(store) == 0
+
+
+def test_bind_keeps_rows_that_match_the_sheet_clean(store):
+    store.insert_many(bot.ACTIONS_SHEET_NAME, [_action(1, "dice", "2024-05-02T10:00:00+00:00")])
+    first = FakeWorksheet()
+    sync = bot.DailyStatsSheetSync(store)
+    sync.bind(first)
+    sync.flush()
+
+    # перезапуск: вкладка уже совпадает с базой — писать нечего
+    again = bot.DailyStatsSheetSync(store)
+    copy = FakeWorksheet(first.values)
+    again.bind(copy)
+    again.flush()
+    assert copy.appends == 0 and copy.updates == 0
+
+
+def test_append_without_updated_range_resolves_rows_from_the_sheet(store):
+    sync = bot.DailyStatsSheetSync(store)
+    ws = FakeWorksheet(report_range=False)
+    sync.bind(ws)
+    store.insert_many(bot.ACTIONS_SHEET_NAME, [_action(1, "dice", "2024-05-02T10:00:00+00:00")])
+    sync.flush()
+    assert _dirty(store) == 0
+    assert store.query("SELECT sheet_row FROM daily_stats")[0]["sheet_row"] == 2
+
+    store.insert_many(bot.ACTIONS_SHEET_NAME, [_action(2, "dice", "2024-05-02T11:00:00+00:00")])
+    sync.flush()
+    assert ws.appends == 1  # ключ не дописан второй раз
+    assert len(ws.values) == 2
+    assert list(_sheet_counts(ws).values()) == [2]
@@ -0,0 +1,49 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("gspread")
+bot = pytest.importorskip("bot")
+
+
+class FakeBot:
+    def __init__(self):
+        self.calls = []
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.calls.append(user_id)
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(status="member")
+
+
+@pytest.fixture
+def refresher(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "CHANNEL_USERNAME", "@channel")
+    monkeypatch.setattr(bot, "set_subscribed_flags", lambda changed: None)
+    members = bot.ChannelMembers(bot.EventStore(str(tmp_path / "events.sqlite3")))
+    return bot.MembershipRefresher(members, ttl=3600, concurrency=4, rate=1000, batch=50)
+
+
+def test_concurrent_refreshes_poll_each_user_once(refresher):
+    fake = FakeBot()
+
+    async def scenario():
+        return await asyncio.gather(
+            refresher.refresh(fake, ["1", "2", "3"]),
+            refresher.refresh(fake, ["2", "3", "4"]),
+            refresher.refresh(fake, ["1", "2", "3"]),
+        )
+
+    checked = asyncio.run(scenario())
+    assert sorted(fake.calls) == [1, 2, 3, 4]
+    assert checked == [3, 1, 0]
+    assert not refresher.running
+
+
+def test_fresh_statuses_are_not_polled_again(refresher):
+    fake = FakeBot()
+    asyncio.run(refresher.refresh(fake, ["1"]))
+    asyncio.run(refresher.refresh(fake, ["1"]))
+    assert fake.calls == [1]
@@ -0,0 +1,111 @@
+import threading
+from datetime import datetime, UTC
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("gspread")
+bot = pytest.importorskip("bot")
+
+
+def _row(row_id: int, ts_iso: str = "2024-05-01T12:00:00+00:00") -> dict:
+    return {"id": row_id, "user_id": str(row_id), "action": "enter_bot", "source": "bot",
+            "ts_iso": ts_iso, "username": "", "first_name": ""}
+
+
+class FakeLoader:
+    """Отдаёт строки с id > after_id, как load_actions."""
+
+    def __init__(self, rows=(), gate: threading.Event | None = None):
+        self.rows = list(rows)
+        self.calls = 0
+        self.gate = gate
+
+    def __call__(self, after_id: int = 0):
+        self.calls += 1
+        if self.gate is not None:
+            self.gate.wait(5)
+        return [bot._normalize_action_record(dict(r)) for r in self.rows if r["id"] > after_id]
+
+
+def _cache(loader, ttl=60):
+    return bot.RowCache("test", loader, bot._normalize_action_record, ttl)
+
+
+def _ids(cache):
+    return sorted(r["id"] for r in cache.get())
+
+
+def test_concurrent_misses_share_one_load():
+    gate = threading.Event()
+    loader = FakeLoader([_row(1), _row(2)], gate=gate)
+    cache = _cache(loader)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(len(cache.get()))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    gate.set()
+    for t in threads:
+        t.join(5)
+    assert loader.calls == 1
+    assert results == [2] * 8
+
+
+def test_write_through_is_visible_and_not_reloaded():
+    loader = FakeLoader([_row(1)])
+    cache = _cache(loader, ttl=0)
+    assert _ids(cache) == [1]
+
+    loader.rows.append(_row(2))
+    cache.write_through([_row(2)])
+    with cache._lock:
+        assert sorted(r["id"] for r in cache._rows) == [1, 2]
+
+    cache._refresh(bot.Future())  # дочитываем строку 2 из «базы»
+    assert _ids(cache) == [1, 2]
+
+
+def test_write_through_after_refresh_loaded_the_row():
+    # _refresh уже дочитал строку 3, а store_rows только теперь зовёт write_through
+    loader = FakeLoader([_row(1)])
+    cache = _cache(loader, ttl=0)
+    cache.get()
+    loader.rows.append(_row(3))
+    cache._refresh(bot.Future())
+
+    cache.write_through([_row(3)])
+    cache.write_through([_row(3)])
+    assert _ids(cache) == [1, 3]
+    with cache._lock:
+        assert len(cache._by_day[int(cache._rows[-1]["ts"] // 86400)]) == 2
+
+
+def test_write_through_skipped_until_first_load():
+    loader = FakeLoader([_row(1)])
+    cache = _cache(loader)
+    cache.write_through([_row(1)])
+    assert _ids(cache) == [1]
+
+
+def test_rows_between_uses_day_buckets():
+    rows = [
+        _row(1, "2024-05-01T10:00:00+00:00"),
+        _row(2, "2024-05-02T23:59:59+00:00"),
+        _row(3, "2024-05-03T00:00:00+00:00"),
+        _row(4, "2024-05-05T08:00:00+00:00"),
+    ]
+    cache = _cache(FakeLoader(rows))
+    start = datetime(2024, 5, 2, tzinfo=UTC).timestamp()
+    end = datetime(2024, 5, 3, 12, tzinfo=UTC).timestamp()
+    assert sorted(r["id"] for r in cache.rows_between(start, end)) == [2, 3]
+    with cache._lock:
+        assert len(cache._by_day) == 4
+
+
+def test_invalidate_drop_reloads_everything():
+    loader = FakeLoader([_row(1), _row(2)])
+    cache = _cache(loader)
+    cache.get()
+    cache.invalidate(drop=True)
+    assert _ids(cache) == [1, 2]
+    assert loader.calls == 2
@@ -0,0 +1,64 @@
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("gspread")
+bot = pytest.importorskip("bot")
+
+
+class FakeClock:
+    """monotonic() и sleep() без реального ожидания."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(bot, "time_module", fake)
+    return fake
+
+
+def test_interactive_calls_use_the_whole_quota(clock):
+    bucket = bot.TokenBucket("t", per_minute=60, reserve_share=0.25)
+    for _ in range(60):
+        bucket.acquire()
+    assert clock.slept == 0
+    assert bucket.waits == 0
+
+    bucket.acquire()
+    assert clock.slept == pytest.approx(1.0)  # 60 в минуту — токен в секунду
+    assert bucket.waits == 1
+
+
+def test_background_calls_leave_the_reserve(clock):
+    bucket = bot.TokenBucket("t", per_minute=60, reserve_share=0.25)
+    for _ in range(45):
+        bucket.acquire(background=True)
+    assert clock.slept == 0
+
+    # резерв 15 токенов: фоновый вызов ждёт пополнения, интерактивный — нет
+    bucket.acquire()
+    assert clock.slept == 0
+    bucket.acquire(background=True)
+    assert clock.slept > 0
+    assert bucket._tokens >= bucket.reserve
+
+
+def test_refill_is_capped_at_capacity(clock):
+    bucket = bot.TokenBucket("t", per_minute=60, reserve_share=0.0)
+    bucket.acquire()
+    clock.now += 3600
+    for _ in range(60):
+        bucket.acquire()
+    assert clock.slept == 0
+    bucket.acquire()
+    assert clock.slept > 0